@@ -1,15 +1,22 @@
+import logging
 from werkzeug.utils import find_modules, import_string
+from pymongo.errors import PyMongoError
 from flask_mongoengine import MongoEngine
 from flasgger import Swagger
 from flask_cors import CORS
 
 from config import Config
 from toolset import StatusCode, ApiError, Service
+from app.portal import Portal
+from app.scheduler import Scheduler
+from app.monitoring import MongoCommandMetrics, QueryProfiler
 
 
 db = MongoEngine()
 cors = CORS()
 swg = Swagger()
+portal = Portal()
+scheduler = Scheduler()
 
 
 def register_apis(app):
@@ -19,6 +26,68 @@ def register_apis(app):
             app.register_blueprint(mod.api)
 
 
+def create_indexes(app):
+    from app.models import Dataset, Policy, StorageEventRecord, JobStatus, BeamlineUsage
+    from app.jobs import apply_storage_retention
+    with app.app_context():
+        for document in [Dataset, Policy, StorageEventRecord, JobStatus, BeamlineUsage]:
+            try:
+                document.ensure_indexes()
+            except PyMongoError as e:
+                logging.getLogger(__name__).warning(
+                    'Could not create the indexes for {}: {}'.format(document.__name__, e))
+
+        try:
+            apply_storage_retention(app.config['STORAGE_EVENT_RETENTION'])
+        except PyMongoError as e:
+            logging.getLogger(__name__).warning(
+                'Could not apply the storage event retention: {}'.format(e))
+
+
+def check_summaries(app):
+    from app.models import Dataset
+    logger = logging.getLogger(__name__)
+    with app.app_context():
+        try:
+            # summaries written by earlier versions have no beamline, which is indexed
+            outdated = Dataset._get_collection().count_documents({'summary.beamline': None})
+        except PyMongoError as e:
+            logger.warning('Could not check the dataset summaries: {}'.format(e))
+            return
+
+    if outdated > 0:
+        logger.warning('{} datasets have a missing or outdated summary and are not found by '
+                       'all searches, please run flask backfill-summaries'.format(outdated))
+
+
+def register_commands(app):
+    from app.commands import commands
+    for command in commands:
+        app.cli.add_command(command)
+
+
+def register_jobs():
+    from app.jobs import scheduled_jobs
+    for name, job in scheduled_jobs.items():
+        scheduler.register(name, job)
+
+
+def register_monitoring(app):
+    listeners = []
+    if app.config['METRICS_ENABLED']:
+        listeners.append(MongoCommandMetrics(app.metrics))
+    if app.config['DB_PROFILING'] != 'off':
+        listeners.append(QueryProfiler(app))
+
+    # the listeners are handed to the MongoDB client when the connection is created
+    if len(listeners) > 0:
+        settings = app.config['MONGODB_SETTINGS']
+        app.config['MONGODB_SETTINGS'] = {
+            **settings,
+            'event_listeners': list(settings.get('event_listeners', [])) + listeners
+        }
+
+
 def register_error_handlers(app):
     app.register_error_handler(ApiError, lambda err: err.to_flask_response())
     app.register_error_handler(StatusCode.NotFound,
@@ -39,9 +108,18 @@ def create_app(config_class=Config):
 
     register_apis(app)
     register_error_handlers(app)
+    register_commands(app)
 
+    register_monitoring(app)
     db.init_app(app)
     cors.init_app(app)
     swg.init_app(app)
+    portal.init_app(app)
+    scheduler.init_app(app)
+    register_jobs()
+
+    if app.config['MONGODB_CREATE_INDEXES']:
+        create_indexes(app)
+        check_summaries(app)
 
     return app
@@ -6,3 +6,15 @@ class LifecycleStateType:
     RENEWED = 'renewed'
     DROPPED = 'dropped'
     DELETED = 'deleted'
+
+
+class BulkResultType:
+    CREATED = 'created'
+    EXISTS = 'exists'
+    STORED = 'stored'
+    NOT_FOUND = 'not_found'
+    INVALID = 'invalid'
+    QUOTA_EXCEEDED = 'quota_exceeded'
+    PORTAL_ERROR = 'portal_error'
+    POLICY_ERROR = 'policy_error'
+    ERROR = 'error'
@@ -1,24 +1,71 @@
-from flask import Blueprint, current_app
+import logging
+from flask import Blueprint, current_app, request, url_for
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from dateutil import parser
-from distutils.util import strtobool
-from portalapi import Authentication, PortalAPI
-from portalapi.exceptions import AuthenticationFailed, RequestFailed
-from voluptuous import (Schema, Required, Optional, Coerce, Any, Datetime, Boolean,
-                        REMOVE_EXTRA)
+from voluptuous import (Schema, Required, Optional, Coerce, Any, All, Length, Range,
+                        Datetime, Boolean, Match, Invalid, REMOVE_EXTRA)
+from bson import ObjectId, decode, encode
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
 from mongoengine.queryset.visitor import Q
-from mongoengine.errors import NotUniqueError, InvalidDocumentError
-
-from .utils import utc_to_local
-from .const import LifecycleStateType
-from app.models import (Dataset, Visit, VisitType, PrincipalInvestigator,
-                        Organisation, StorageEvent, LifecycleState, Policy)
+from mongoengine.errors import (NotUniqueError, InvalidDocumentError, SaveConditionError,
+                                ValidationError)
+
+from .utils import (utc_to_local, local_time, local_time_converter, get_visit_from_portal,
+                    get_visits_from_portal, encode_cursor, decode_cursor)
+from .const import LifecycleStateType, BulkResultType
+from app import scheduler
+from app.jobs import refresh_visits, expire_datasets
+from app.cache import policy_cache
+from app.summary import (is_dataset_excluded, build_summary, build_document_summary,
+                         latest_storage_events,
+                         storage_summary_increments, normalise_key)
+from app.usage import increment_usage, move_usage, transfer_usage, exceeds_quota, load_usage
+from app.models import Dataset, StorageEvent, StorageEventRecord, LifecycleState
 from toolset.decorators import dataschema
-from toolset import ApiResponse, ApiError, StatusCode
+from toolset import ApiResponse, ApiStreamResponse, ApiError, StatusCode
+from toolset.response import GZIP_ETAG_SUFFIX
 
 
 api = Blueprint('dataset', __name__, url_prefix='/dataset')
 
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+
+# the fields of a storage event, as reported by the storage crawlers
+STORAGE_EVENT_FIELDS = {
+    Required('name'): All(str, Match(r'^[^.$]+$')),
+    Required('host'): str,
+    Required('path'): str,
+    Required('size'): Coerce(int),
+    Required('count'): Coerce(int),
+    Optional('error', default=''): str
+}
+
+STORAGE_BATCH_EVENT_SCHEMA = Schema({
+    Required('epn'): str,
+    **STORAGE_EVENT_FIELDS
+}, extra=REMOVE_EXTRA)
+
+# the database fields each key of the dataset response is built from
+DATASET_RESPONSE_FIELDS = OrderedDict([
+    ('epn', ['epn']),
+    ('beamline', ['visit.beamline']),
+    ('status', ['summary.status']),
+    ('excluded', ['summary.excluded']),
+    ('expires_on', ['summary.expires_on']),
+    ('available', ['summary.locations', 'summary.unavailable']),
+    ('size', ['summary.size']),
+    ('count', ['summary.count']),
+    ('contact', ['visit.pi.email']),
+    ('notes', ['notes']),
+    ('visit', ['visit.id', 'visit.start_date', 'visit.end_date', 'visit.title']),
+    ('type', ['visit.type']),
+    ('pi', ['visit.pi'])
+])
+
 
 # ---------------------------------------------------------------------------------------------------------------------
 #                                                 Dataset API
@@ -66,56 +113,178 @@ def create_dataset(epn):
          id: 5ae30aa3aaaa2f4d8096f575
     """
     try:
-        visit = _get_visit_from_portal(epn)
+        visit = get_visit_from_portal(epn)
 
-        pl = Policy.objects(beamline=visit.beamline).first()
+        pl = policy_cache.get_by_beamline(visit.beamline)
         if pl is None:
             raise ApiError(
                 StatusCode.InternalServerError,
                 'A policy for the {} beamline does not exist'.format(visit.beamline))
 
-        # Excluded experiment types don't expire
-        if _is_dataset_excluded(visit, pl):
-            expiry_date = None
-        else:
-            expiry_date = visit.start_date + timedelta(days=pl.retention)
-
-        new_ds = Dataset(epn=epn, notes='',
-                         policy=pl,
-                         visit=visit,
-                         storage={},
-                         lifecycle=[LifecycleState(
-                             type=LifecycleStateType.NORMAL,
-                             created_at=datetime.now(tz=current_app.config['TIMEZONE']),
-                             expires_on=expiry_date,
-                             user_id=None,
-                             user_name='auto',
-                             notes='auto generated during dataset creation')
-                         ])
+        new_ds = _new_dataset(epn, visit, pl)
         new_ds.save()
+        increment_usage([(visit.beamline, new_ds.summary.status, 0, 0, 1)])
         return ApiResponse(_build_dataset_response(new_ds))
     except NotUniqueError:
         raise ApiError(StatusCode.BadRequest,
                        'Dataset with EPN {} already exist'.format(epn))
 
 
+@api.route('/bulk', methods=['POST'])
+@dataschema(Schema({
+    Required('epns'): All([str], Length(min=1))
+}, extra=REMOVE_EXTRA), format='json')
+def create_datasets(epns):
+    """
+    Create new datasets for a list of existing visits
+
+    The visit information for all EPNs is retrieved concurrently from the User Portal,
+    where every distinct beamline is only requested once. The policies are looked up
+    once per beamline and all new datasets are inserted with a single database
+    operation. A failure for one EPN does not affect the others.
+
+    ---
+    tags:
+     - Dataset
+    consumes:
+     - application/json
+    produces:
+     - application/json
+    parameters:
+     - name: body
+       in: body
+       schema:
+         type: object
+         properties:
+           epns:
+             type: array
+             items:
+               type: string
+         required: ['epns']
+    responses:
+     200:
+       description: The result of the registration for each EPN
+       schema:
+         properties:
+           datasets:
+             type: array
+             items:
+               type: object
+               properties:
+                 epn:
+                   type: string
+                 result:
+                   type: string
+                   enum: [created, exists, portal_error, policy_error, invalid, error]
+                 message:
+                   type: string
+    """
+    epns = list(OrderedDict.fromkeys(epns))
+    if len(epns) > current_app.config['DATASET_BULK_LIMIT']:
+        raise ApiError(
+            StatusCode.BadRequest,
+            'At most {} EPNs can be registered at once'.format(
+                current_app.config['DATASET_BULK_LIMIT']))
+
+    results = OrderedDict((epn, {'epn': epn}) for epn in epns)
+
+    def set_result(epn, result, message=None):
+        results[epn]['result'] = result
+        if message is not None:
+            results[epn]['message'] = message
+
+    # skip the datasets that already exist before contacting the User Portal
+    for epn in Dataset.objects(epn__in=epns).scalar('epn'):
+        set_result(epn, BulkResultType.EXISTS)
+
+    fetched = {}
+    for epn, visit in get_visits_from_portal(
+            [epn for epn in epns if 'result' not in results[epn]]):
+        if isinstance(visit, ApiError):
+            set_result(epn, BulkResultType.PORTAL_ERROR, visit.message)
+        else:
+            fetched[epn] = visit
+    visits = OrderedDict((epn, fetched[epn]) for epn in epns if epn in fetched)
+
+    policies = {beamline: policy_cache.get_by_beamline(beamline)
+                for beamline in {visit.beamline for visit in visits.values()}}
+
+    new_datasets = []
+    for epn, visit in visits.items():
+        if policies[visit.beamline] is not None:
+            new_ds = _new_dataset(epn, visit, policies[visit.beamline])
+            try:
+                new_ds.validate()
+            except ValidationError as e:
+                set_result(epn, BulkResultType.INVALID, str(e))
+                continue
+            new_datasets.append(new_ds)
+        else:
+            set_result(epn, BulkResultType.POLICY_ERROR,
+                       'A policy for the {} beamline does not exist'.format(visit.beamline))
+
+    if len(new_datasets) > 0:
+        failed = {}
+        try:
+            Dataset._get_collection().insert_many([ds.to_mongo() for ds in new_datasets],
+                                                  ordered=False)
+        except BulkWriteError as e:
+            failed = {err['index']: err for err in e.details['writeErrors']}
+
+        increment_usage((new_ds.visit.beamline, new_ds.summary.status, 0, 0, 1)
+                        for idx, new_ds in enumerate(new_datasets) if idx not in failed)
+
+        for idx, new_ds in enumerate(new_datasets):
+            if idx not in failed:
+                set_result(new_ds.epn, BulkResultType.CREATED)
+            elif failed[idx]['code'] == DUPLICATE_KEY_ERROR:
+                set_result(new_ds.epn, BulkResultType.EXISTS)
+            else:
+                set_result(new_ds.epn, BulkResultType.ERROR, failed[idx]['errmsg'])
+
+    return ApiResponse({'datasets': list(results.values())})
+
+
 @api.route('', methods=['GET'])
 @dataschema(Schema({
     'epn': str,
     'beamline': str,
     'pi_name': str,
     'pi_email': str,
+    'pi_email_prefix': str,
     'pi_org': str,
     'status': Any(LifecycleStateType.NORMAL, LifecycleStateType.EXPIRED,
                   LifecycleStateType.RENEWED, LifecycleStateType.DROPPED,
                   LifecycleStateType.DELETED),
     'type': str,
-    'excluded': str
+    'excluded': Boolean(),
+    'available': Boolean(),
+    'size_min': Coerce(int),
+    'size_max': Coerce(int),
+    'expires_from': Datetime(format='%Y-%m-%dT%H:%M:%S'),
+    'expires_to': Datetime(format='%Y-%m-%dT%H:%M:%S'),
+    'limit': All(Coerce(int), Range(min=1)),
+    'after': str,
+    'stream': Boolean(),
+    'fields': str
 }, extra=REMOVE_EXTRA))
-def search_datasets(**kwargs):
+def search_datasets(limit=None, after=None, stream=False, fields=None, **kwargs):
     """
     Search for datasets
 
+    The datasets are returned in pages, ordered by the time they were created. If more
+    datasets match the search, the response contains a cursor in 'next' that can be
+    passed as 'after' in order to retrieve the next page.
+
+    The beamline is matched exactly and 'pi_email_prefix' by the beginning of the PI
+    email, both ignoring the case and using an index. All other text parameters,
+    including 'pi_email', match any part of the text. Datasets without a summary are
+    matched by their visit and lifecycle instead.
+
+    If the request accepts 'application/x-ndjson' or 'stream' is set, all matching
+    datasets are streamed instead, with one JSON document per line. If an error occurs
+    while the datasets are streamed, the last line is a document with the key 'error'.
+
     ---
     tags:
      - Dataset
@@ -123,13 +292,59 @@ def search_datasets(**kwargs):
      - application/json
     produces:
      - application/json
+    parameters:
+     - name: limit
+       in: query
+       type: integer
+       description: The maximum number of datasets per page, capped by the service.
+     - name: after
+       in: query
+       type: string
+       description: The cursor returned as 'next' by the previous page.
+     - name: stream
+       in: query
+       type: boolean
+       description: Stream all matching datasets as newline delimited JSON.
+     - name: fields
+       in: query
+       type: string
+       description: Comma separated list of the dataset keys that should be returned.
+     - name: pi_email_prefix
+       in: query
+       type: string
+       description: Only return datasets whose PI email starts with this text.
+     - name: available
+       in: query
+       type: boolean
+       description: Only return datasets that are, or are not, available on all storage.
+     - name: size_min
+       in: query
+       type: integer
+       description: Only return datasets with a total size of at least this many bytes.
+     - name: size_max
+       in: query
+       type: integer
+       description: Only return datasets with a total size of at most this many bytes.
+     - name: expires_from
+       in: query
+       type: string
+       description: Only return datasets expiring on or after this date.
+     - name: expires_to
+       in: query
+       type: string
+       description: Only return datasets expiring on or before this date.
     """
+    fields = _parse_dataset_fields(fields)
+
     query = Q()
     if 'epn' in kwargs:
         query = query & Q(epn__icontains=kwargs['epn'])
 
+    # datasets that have not been backfilled yet are matched by their visit and lifecycle
     if 'beamline' in kwargs:
-        query = query & Q(visit__beamline__iexact=kwargs['beamline'])
+        query = query & (Q(summary__beamline=normalise_key(kwargs['beamline'])) |
+                         (Q(summary__beamline=None) &
+                          Q(visit__beamline__iexact=kwargs['beamline'])))
 
     if 'pi_name' in kwargs:
         query = query & (Q(visit__pi__first_names__icontains=kwargs['pi_name']) |
@@ -138,31 +353,70 @@ def search_datasets(**kwargs):
     if 'pi_email' in kwargs:
         query = query & Q(visit__pi__email__icontains=kwargs['pi_email'])
 
+    if 'pi_email_prefix' in kwargs:
+        query = query & (Q(summary__contact__startswith=normalise_key(kwargs['pi_email_prefix'])) |
+                         (Q(summary__contact=None) &
+                          Q(visit__pi__email__istartswith=kwargs['pi_email_prefix'])))
+
     if 'pi_org' in kwargs:
         query = query & (Q(visit__pi__org__name_short__icontains=kwargs['pi_org']) |
                          Q(visit__pi__org__name_long__icontains=kwargs['pi_org']))
 
     if 'status' in kwargs:
-        query = query & Q(lifecycle__0__type__exact=kwargs['status'])
+        query = query & (Q(summary__status=kwargs['status']) |
+                         (Q(summary__status=None) & Q(lifecycle__0__type__exact=kwargs['status'])))
 
     if 'type' in kwargs:
         query = query & (Q(visit__type__name_short__icontains=kwargs['type']) |
                          Q(visit__type__name_long__icontains=kwargs['type']))
 
-    ds = Dataset.objects(query)
+    if 'excluded' in kwargs:
+        query = query & Q(summary__excluded=kwargs['excluded'])
 
-    if ds is not None:
-        # mongoDB doesn't do joins, so we have to perform the search manually
-        if 'excluded' in kwargs:
-            excluded = bool(strtobool(kwargs['excluded']))
-            datasets = []
-            for d in ds.select_related():
-                if _is_dataset_excluded(d.visit, d.policy) == excluded:
-                    datasets.append(d)
+    if 'available' in kwargs:
+        if kwargs['available']:
+            query = query & Q(summary__unavailable=0) & Q(summary__locations__gt=0)
         else:
-            datasets = ds
+            query = query & (Q(summary__unavailable__gt=0) | Q(summary__locations=0))
+
+    if 'size_min' in kwargs:
+        query = query & Q(summary__size__gte=kwargs['size_min'])
 
-        return ApiResponse({'datasets': [_build_dataset_response(d) for d in datasets]})
+    if 'size_max' in kwargs:
+        query = query & Q(summary__size__lte=kwargs['size_max'])
+
+    if 'expires_from' in kwargs:
+        query = query & Q(summary__expires_on__gte=current_app.config['TIMEZONE'].localize(
+            parser.parse(kwargs['expires_from'])))
+
+    if 'expires_to' in kwargs:
+        query = query & Q(summary__expires_on__lte=current_app.config['TIMEZONE'].localize(
+            parser.parse(kwargs['expires_to'])))
+
+    if after is not None:
+        query = query & Q(id__gt=decode_cursor(after))
+
+    limit = min(limit or current_app.config['DATASET_PAGE_SIZE'],
+                current_app.config['DATASET_PAGE_LIMIT'])
+
+    ds = _project_dataset_fields(Dataset.objects(query).order_by('id'), fields)
+
+    if ds is not None:
+        streaming = stream or (
+            request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson'])
+            == 'application/x-ndjson')
+
+        if streaming:
+            # iterate the cursor in batches without keeping the documents around
+            ds = ds.no_cache().batch_size(current_app.config['DATASET_STREAM_BATCH_SIZE'])
+            return ApiStreamResponse(_build_dataset_response(d, fields) for d in ds)
+
+        # fetch one more dataset than requested in order to know whether there is a next page
+        page = list(ds.limit(limit + 1))
+        return ApiResponse({
+            'datasets': [_build_dataset_response(d, fields) for d in page[:limit]],
+            'next': encode_cursor(page[limit - 1].id) if len(page) > limit else None
+        })
     else:
         raise ApiError(
             StatusCode.InternalServerError,
@@ -170,7 +424,10 @@ def search_datasets(**kwargs):
 
 
 @api.route('/<epn>', methods=['GET'])
-def retrieve_dataset(epn):
+@dataschema(Schema({
+    'fields': str
+}, extra=REMOVE_EXTRA))
+def retrieve_dataset(epn, fields=None):
     """
     Retrieve the basic information of a dataset
 
@@ -188,6 +445,10 @@ def retrieve_dataset(epn):
        required: true
        type: string
        description: The EPN of the experiment for which the dataset should be returned.
+     - name: fields
+       in: query
+       type: string
+       description: Comma separated list of the dataset keys that should be returned.
     responses:
       200:
         description: The EPN and the id of the newly created dataset
@@ -195,12 +456,19 @@ def retrieve_dataset(epn):
           epn: 1234a
           id: 5ae30aa3aaaa2f4d8096f575
     """
+    fields = _parse_dataset_fields(fields)
+
+    not_modified = _not_modified(epn)
+    if not_modified is not None:
+        return not_modified
+
     try:
-        ds = Dataset.objects(epn=epn).first()
+        ds = _project_dataset_fields(Dataset.objects(epn=epn), fields).first()
         if ds is not None:
             # hand craft the response message in order to decouple the internal database
             # design from the interface
-            return ApiResponse(_build_dataset_response(ds))
+            return ApiResponse(_build_dataset_response(ds, fields),
+                               headers={'ETag': _etag_header(ds.id, ds.revision)})
         else:
             raise ApiError(
                 StatusCode.InternalServerError,
@@ -226,7 +494,16 @@ def delete_dataset(epn):
     """
     ds = Dataset.objects(epn=epn).first()
     if ds is not None:
-        ds.delete()
+        _check_if_match(ds.id, ds.revision)
+        if Dataset.objects(id=ds.id, **_revision_condition(ds.revision)).delete() == 0:
+            raise ApiError(
+                StatusCode.Conflict,
+                'The dataset for EPN {} was modified concurrently, please try again'
+                .format(epn))
+        StorageEventRecord.objects(epn=epn).delete()
+        if ds.summary is not None:
+            increment_usage([(ds.visit.beamline, ds.summary.status,
+                              -ds.summary.size, -ds.summary.count, -1)])
         return ApiResponse({
             'deleted': True,
             'epn': epn
@@ -245,6 +522,9 @@ def update_visit(epn):
     """
     Update the visit information of a dataset
 
+    If the visit moved to another beamline, the dataset gets the policy of the new
+    beamline and its usage is moved to the new beamline.
+
     ---
     tags:
      - Visit
@@ -256,8 +536,20 @@ def update_visit(epn):
     try:
         ds = Dataset.objects(epn=epn).first()
         if ds is not None:
-            ds.visit = _get_visit_from_portal(epn)
-            ds.save()
+            _check_if_match(ds.id, ds.revision)
+            old_beamline = ds.visit.beamline if ds.visit is not None else None
+            ds.visit = get_visit_from_portal(epn, fresh=True)
+            if ds.visit.beamline != old_beamline:
+                pl = policy_cache.get_by_beamline(ds.visit.beamline)
+                if pl is None:
+                    raise ApiError(
+                        StatusCode.InternalServerError,
+                        'A policy for the {} beamline does not exist'.format(ds.visit.beamline))
+                ds.policy = pl
+
+            _save_dataset(ds)
+            increment_usage(transfer_usage(old_beamline, ds.visit.beamline, ds.summary.status,
+                                           ds.summary.size, ds.summary.count))
 
             return ApiResponse(_build_dataset_response(ds))
         else:
@@ -270,18 +562,58 @@ def update_visit(epn):
             'The dataset for EPN {} seems to be damaged'.format(epn))
 
 
+@api.route('/visit/refresh', methods=['POST'])
+@dataschema(Schema({
+    'beamline': str,
+    'status': Any(LifecycleStateType.NORMAL, LifecycleStateType.EXPIRED,
+                  LifecycleStateType.RENEWED, LifecycleStateType.DROPPED,
+                  LifecycleStateType.DELETED),
+    'start_from': Datetime(format='%Y-%m-%dT%H:%M:%S'),
+    'start_to': Datetime(format='%Y-%m-%dT%H:%M:%S')
+}, extra=REMOVE_EXTRA), format='json')
+def refresh_visits_endpoint(start_from=None, start_to=None, **kwargs):
+    """
+    Refresh the visit information of all or a filtered subset of datasets
+
+    The refresh is started in the background as a run of the refresh-visits job and
+    the request is answered immediately. The visits are fetched concurrently from the
+    User Portal and only the datasets with changed visit information are updated. The
+    outcome of the refresh is returned by GET /jobs.
+
+    ---
+    tags:
+     - Visit
+    consumes:
+     - application/json
+    produces:
+     - application/json
+    responses:
+     202:
+       description: The refresh has been started
+     409:
+       description: A refresh is already running
+    """
+    if start_from is not None:
+        start_from = current_app.config['TIMEZONE'].localize(parser.parse(start_from))
+
+    if start_to is not None:
+        start_to = current_app.config['TIMEZONE'].localize(parser.parse(start_to))
+
+    started = scheduler.trigger(
+        'refresh-visits',
+        lambda: refresh_visits(start_from=start_from, start_to=start_to, **kwargs)['total'])
+    if not started:
+        raise ApiError(StatusCode.Conflict, 'A refresh of the visits is already running')
+
+    return ApiResponse({'job': 'refresh-visits', 'started': True}, StatusCode.Accepted,
+                       headers={'Location': url_for('jobs.retrieve_jobs')})
+
+
 # ---------------------------------------------------------------------------------------------------------------------
 #                                                 Storage API
 # ---------------------------------------------------------------------------------------------------------------------
 @api.route('/<epn>/storage', methods=['POST'])
-@dataschema(Schema({
-    Required('name'): str,
-    Required('host'): str,
-    Required('path'): str,
-    Required('size'): Coerce(int),
-    Required('count'): Coerce(int),
-    Optional('error', default=''): str
-}, extra=REMOVE_EXTRA), format='json')
+@dataschema(Schema(STORAGE_EVENT_FIELDS, extra=REMOVE_EXTRA), format='json')
 def add_storage_event(epn, name, **kwargs):
     """
     Add a new entry to the history of a storage item
@@ -295,33 +627,33 @@ def add_storage_event(epn, name, **kwargs):
      - application/json
     """
     try:
-        ds = Dataset.objects(epn=epn).first()
-        if ds is not None:
-            if name not in ds.storage:
-                ds.storage[name] = []
-
-            ds.storage[name].insert(
-                0,
-                StorageEvent(created_at=datetime.now(tz=current_app.config['TIMEZONE']),
-                             **kwargs)
-            )
-            ds.save()
-
-            return ApiResponse(_build_storage_event_response(ds.storage[name][0]))
-        else:
-            raise ApiError(
-                StatusCode.InternalServerError,
-                'Dataset with EPN {} does not exist'.format(epn))
+        event, beamline = _set_storage_event(
+            epn, name,
+            StorageEvent(created_at=datetime.now(tz=current_app.config['TIMEZONE']), **kwargs))
+        _add_storage_event_records([_storage_event_record(epn, name, event)])
+        return ApiResponse({**_build_storage_event_response(event),
+                            'over_quota': exceeds_quota(beamline)})
     except InvalidDocumentError:
         raise ApiError(
             StatusCode.InternalServerError,
             'The dataset for EPN {} seems to be damaged'.format(epn))
 
 
-@api.route('/<epn>/storage', methods=['GET'])
-def retrieve_storage_details(epn):
+@api.route('/storage/batch', methods=['POST'])
+@dataschema(Schema({
+    Required('events'): All([dict], Length(min=1))
+}, extra=REMOVE_EXTRA), format='json')
+def add_storage_events(events):
     """
-    Retrieve all storage items with their full history
+    Add new entries to the histories of many storage items
+
+    Each event is validated individually. The datasets of all events are read with a
+    single database operation, the most recent event of every storage item is updated
+    with a single bulk operation and all events are added to the storage event history
+    at once. Storage items that were changed concurrently are updated again on their
+    own. An invalid event or unknown EPN does not affect the other
+    events. If the quota is enforced, events that would increase the usage of a
+    beamline beyond its quota are rejected, otherwise they are flagged as over quota.
 
     ---
     tags:
@@ -330,24 +662,263 @@ def retrieve_storage_details(epn):
      - application/json
     produces:
      - application/json
+    parameters:
+     - name: body
+       in: body
+       schema:
+         type: object
+         properties:
+           events:
+             type: array
+             items:
+               type: object
+               properties:
+                 epn:
+                   type: string
+                 name:
+                   type: string
+                 host:
+                   type: string
+                 path:
+                   type: string
+                 size:
+                   type: integer
+                 count:
+                   type: integer
+                 error:
+                   type: string
+         required: ['events']
+    responses:
+     200:
+       description: The result for each event, in the order of the request
+       schema:
+         properties:
+           events:
+             type: array
+             items:
+               type: object
+               properties:
+                 epn:
+                   type: string
+                 name:
+                   type: string
+                 result:
+                   type: string
+                   enum: [stored, not_found, invalid, quota_exceeded, error]
+                 message:
+                   type: string
+                 over_quota:
+                   type: boolean
     """
-    try:
-        ds = Dataset.objects(epn=epn).first()
-        if ds is not None:
-            response = {}
-            for name, events in ds.storage.items():
-                response[name] = [_build_storage_event_response(e) for e in events]
+    if len(events) > current_app.config['DATASET_BULK_LIMIT']:
+        raise ApiError(
+            StatusCode.BadRequest,
+            'At most {} storage events can be added at once'.format(
+                current_app.config['DATASET_BULK_LIMIT']))
+
+    results = [{'epn': e.get('epn'), 'name': e.get('name')} for e in events]
+
+    def set_result(idx, result, message=None):
+        results[idx]['result'] = result
+        if message is not None:
+            results[idx]['message'] = message
+
+    # validate every event on its own and group the valid events by storage location
+    created_at = datetime.now(tz=current_app.config['TIMEZONE'])
+    locations = OrderedDict()
+    for idx, data in enumerate(events):
+        try:
+            data = STORAGE_BATCH_EVENT_SCHEMA(data)
+        except Invalid as err:
+            set_result(idx, BulkResultType.INVALID,
+                       'Invalid data: {} ({})'.format(err.msg, str(err.path)))
+            continue
+
+        epn, name = data.pop('epn'), data.pop('name')
+        locations.setdefault((epn, name), []).append(
+            (idx, StorageEvent(created_at=created_at, **data)))
+
+    # read the current most recent event of all affected locations at once
+    collection = Dataset._get_collection()
+    projection = {'storage.{}'.format(name): 1 for _, name in locations}
+    datasets = {doc['epn']: doc for doc in collection.find(
+        {'epn': {'$in': list({epn for epn, _ in locations})}},
+        {'epn': 1, 'visit.beamline': 1, 'summary.status': 1, **projection})}
+
+    enforce_quota = current_app.config['POLICY_QUOTA_ENFORCED']
+    usage = load_usage() if enforce_quota else {}
+    added_size = {}
+    increments = {}
+    updates = []
+    for (epn, name), location_events in list(locations.items()):
+        if epn not in datasets:
+            for idx, _ in location_events:
+                set_result(idx, BulkResultType.NOT_FOUND,
+                           'Dataset with EPN {} does not exist'.format(epn))
+            del locations[(epn, name)]
+            continue
+
+        try:
+            previous = _previous_storage_event(datasets[epn], name)
+        except ApiError as e:
+            for idx, _ in location_events:
+                set_result(idx, BulkResultType.ERROR, e.message)
+            del locations[(epn, name)]
+            continue
+
+        # only the last event of a location in the request becomes its most recent event
+        beamline = datasets[epn].get('visit', {}).get('beamline')
+        increment = storage_summary_increments(previous, location_events[-1][1])
+
+        if enforce_quota and (increment['summary.size'] > 0) and\
+                exceeds_quota(beamline, added_size.get(beamline, 0) + increment['summary.size'],
+                              usage.get(beamline, {})):
+            for idx, _ in location_events:
+                set_result(idx, BulkResultType.QUOTA_EXCEEDED,
+                           'The storage event would exceed the quota of the {} beamline'
+                           .format(beamline))
+            del locations[(epn, name)]
+            continue
+
+        added_size[beamline] = added_size.get(beamline, 0) + increment['summary.size']
+        increments[(epn, name)] = (beamline, datasets[epn].get('summary', {}).get('status'),
+                                   increment['summary.size'], increment['summary.count'], 0)
+        updates.append(((epn, name), (
+            _storage_event_query(datasets[epn]['_id'], name, previous),
+            _storage_event_update(name, previous, location_events[-1][1]))))
+
+    # update the most recent event of all locations at once, each conditional on the
+    # event it replaces
+    errors = {}
+    matched = 0
+    if len(updates) > 0:
+        try:
+            matched = collection.bulk_write([UpdateOne(query, update)
+                                             for _, (query, update) in updates],
+                                            ordered=False).matched_count
+        except BulkWriteError as e:
+            errors = {err['index']: err['errmsg'] for err in e.details['writeErrors']}
+            matched = e.details['nMatched']
+        except PyMongoError as e:
+            errors = {idx: str(e) for idx in range(len(updates))}
+
+    for idx, message in errors.items():
+        key = updates[idx][0]
+        del increments[key]
+        for event_idx, _ in locations.pop(key):
+            set_result(event_idx, BulkResultType.ERROR, message)
+
+    # some locations were changed concurrently, find them by reading back their most
+    # recent event and update them one by one against their new most recent event,
+    # which also updates the usage counters
+    if matched + len(errors) < len(updates):
+        for epn, name in _unmatched_storage_events(
+                collection, [(datasets[epn]['_id'], epn, name, locations[(epn, name)][-1][1])
+                             for idx, ((epn, name), _) in enumerate(updates)
+                             if idx not in errors]):
+            del increments[(epn, name)]
+            try:
+                _set_storage_event(epn, name, locations[(epn, name)][-1][1])
+            except ApiError as e:
+                for idx, _ in locations.pop((epn, name)):
+                    set_result(idx, BulkResultType.ERROR, e.message)
+
+    increment_usage(increments.values())
+
+    over_quota = {beamline: exceeds_quota(beamline) for beamline in
+                  {datasets[epn].get('visit', {}).get('beamline') for epn, _ in locations}}
+
+    records = []
+    for (epn, name), location_events in locations.items():
+        for idx, event in location_events:
+            records.append(_storage_event_record(epn, name, event))
+            set_result(idx, BulkResultType.STORED)
+            results[idx]['over_quota'] = over_quota[datasets[epn].get('visit', {}).get('beamline')]
+
+    if len(records) > 0:
+        _add_storage_event_records(records)
+
+    return ApiResponse({'events': results})
 
-            return ApiResponse({'storage': response})
-        else:
-            raise ApiError(
-                StatusCode.InternalServerError,
-                'Dataset with EPN {} does not exist'.format(epn))
 
-    except InvalidDocumentError:
+@api.route('/<epn>/storage', methods=['GET'])
+@dataschema(Schema({
+    'name': str,
+    'limit': All(Coerce(int), Range(min=1)),
+    'after': str
+}, extra=REMOVE_EXTRA))
+def retrieve_storage_details(epn, name=None, limit=None, after=None):
+    """
+    Retrieve the history of the storage items
+
+    The events are grouped by storage item and ordered from the most recent to the
+    oldest event. If 'limit' or 'after' is given, the events are returned in pages and
+    if there are more events, the response contains a cursor in 'next' that can be
+    passed as 'after' to retrieve the following page. Otherwise the full history is
+    returned.
+
+    ---
+    tags:
+     - Storage
+    consumes:
+     - application/json
+    produces:
+     - application/json
+    parameters:
+     - name: name
+       in: query
+       type: string
+       description: Only return the history of this storage item.
+     - name: limit
+       in: query
+       type: integer
+       description: The maximum number of events per page, capped by the service.
+     - name: after
+       in: query
+       type: string
+       description: The 'next' cursor of the previous page.
+    """
+    if Dataset.objects(epn=epn).count() == 0:
         raise ApiError(
             StatusCode.InternalServerError,
-            'The dataset for EPN {} seems to be damaged'.format(epn))
+            'Dataset with EPN {} does not exist'.format(epn))
+
+    query = Q(epn=epn)
+    if name is not None:
+        query = query & Q(name=name)
+
+    if after is not None:
+        last = StorageEventRecord.objects(id=decode_cursor(after), epn=epn)\
+            .only('name', 'created_at').first()
+        if last is None:
+            raise ApiError(StatusCode.BadRequest, 'Invalid pagination cursor')
+
+        query = query & (Q(name__gt=last.name) |
+                         Q(name=last.name, created_at__lt=last.created_at) |
+                         Q(name=last.name, created_at=last.created_at, id__lt=last.id))
+
+    events = StorageEventRecord.objects(query).order_by('name', '-created_at', '-id')
+
+    if (limit is None) and (after is None):
+        response = OrderedDict()
+        for event in events.no_cache():
+            response.setdefault(event.name, []).append(_build_storage_event_response(event))
+        return ApiResponse({'storage': response})
+
+    limit = min(limit or current_app.config['DATASET_PAGE_SIZE'],
+                current_app.config['DATASET_PAGE_LIMIT'])
+
+    # fetch one more event than requested in order to know whether there is a next page
+    page = list(events.limit(limit + 1))
+
+    response = OrderedDict()
+    for event in page[:limit]:
+        response.setdefault(event.name, []).append(_build_storage_event_response(event))
+
+    return ApiResponse({
+        'storage': response,
+        'next': encode_cursor(page[limit - 1].id) if len(page) > limit else None
+    })
 
 
 @api.route('/<epn>/storage/last', methods=['GET'])
@@ -363,15 +934,20 @@ def retrieve_storage_last(epn):
     produces:
      - application/json
     """
+    not_modified = _not_modified(epn)
+    if not_modified is not None:
+        return not_modified
+
     try:
-        ds = Dataset.objects(epn=epn).first()
-        if ds is not None:
+        # read the raw document, which may still hold the storage history of a location
+        doc = Dataset._get_collection().find_one({'epn': epn}, {'revision': 1, 'storage': 1})
+        if doc is not None:
             response = {}
-            for name, events in ds.storage.items():
-                response[name] = _build_storage_event_response(events[0])\
-                    if len(events) > 0 else {}
+            for name, event in latest_storage_events(doc).items():
+                response[name] = _build_storage_event_response(StorageEvent._from_son(event))
 
-            return ApiResponse({'storage': response})
+            return ApiResponse({'storage': response},
+                               headers={'ETag': _etag_header(doc['_id'], doc.get('revision'))})
         else:
             raise ApiError(
                 StatusCode.InternalServerError,
@@ -406,59 +982,54 @@ def add_lifecycle_renew_state(epn, days=None, expiry_date=None, **kwargs):
     produces:
      - application/json
     """
-    try:
-        ds = Dataset.objects(epn=epn).first()
-        if ds is not None:
+    def renew(ds, current_state):
+        # check that the dataset is not excluded from the policy
+        pl = policy_cache.get_for_dataset(ds)
+        if is_dataset_excluded(ds.visit, pl):
+            raise ApiError(
+                StatusCode.InternalServerError,
+                'The policy does not allow the dataset to be renewed')
 
-            # check that the dataset is not excluded from the policy
-            if _is_dataset_excluded(ds.visit, ds.policy):
-                raise ApiError(
-                    StatusCode.InternalServerError,
-                    'The policy does not allow the dataset to be renewed')
+        # check that the dataset is in a state in which it can be renewed
+        if current_state is None:
+            raise ApiError(
+                StatusCode.InternalServerError,
+                'Cannot renew a dataset that has no lifecycle state yet')
 
-            # check that the dataset is in a state in which it can be renewed
-            if len(ds.lifecycle) == 0:
-                raise ApiError(
-                    StatusCode.InternalServerError,
-                    'Cannot renew a dataset that has no lifecycle state yet')
+        if current_state.type not in [LifecycleStateType.NORMAL,
+                                      LifecycleStateType.EXPIRED,
+                                      LifecycleStateType.RENEWED]:
+            raise ApiError(
+                StatusCode.InternalServerError,
+                'The dataset is in the wrong state and cannot be renewed')
 
-            current_state = ds.lifecycle[0]
-            if current_state.type not in [LifecycleStateType.NORMAL,
-                                          LifecycleStateType.EXPIRED,
-                                          LifecycleStateType.RENEWED]:
-                raise ApiError(
-                    StatusCode.InternalServerError,
-                    'The dataset is in the wrong state and cannot be renewed')
+        # a dataset without an expiry date, for example because it was excluded by its
+        # policy when it was created, is renewed starting from today
+        current_expiry = utc_to_local(current_state.expires_on) or\
+            datetime.now(tz=current_app.config['TIMEZONE'])
 
-            # if neither a number of days was provided nor an expiry date,
-            # extend the expiry date by the retention days given in the policy
-            if (days is None) and (expiry_date is None):
-                expires_on = utc_to_local(current_state.expires_on) +\
-                             timedelta(days=ds.policy.retention)
+        # if neither a number of days was provided nor an expiry date,
+        # extend the expiry date by the retention days given in the policy
+        if (days is None) and (expiry_date is None):
+            expires_on = current_expiry + timedelta(days=pl.retention)
 
-            # if a number of days is not given but an expiry date, use the expiry date
-            elif (days is None) and (expiry_date is not None):
-                expires_on = current_app.config['TIMEZONE'].localize(
-                    parser.parse(expiry_date))
+        # if a number of days is not given but an expiry date, use the expiry date
+        elif (days is None) and (expiry_date is not None):
+            expires_on = current_app.config['TIMEZONE'].localize(
+                parser.parse(expiry_date))
 
-            else:
-                expires_on = utc_to_local(current_state.expires_on) + timedelta(days=days)
+        else:
+            expires_on = current_expiry + timedelta(days=days)
 
-            ds.lifecycle.insert(
-                0,
-                LifecycleState(
-                    type=LifecycleStateType.RENEWED,
-                    created_at=datetime.now(tz=current_app.config['TIMEZONE']),
-                    expires_on=expires_on,
-                    **kwargs)
-            )
-            ds.save()
+        return LifecycleState(
+            type=LifecycleStateType.RENEWED,
+            created_at=datetime.now(tz=current_app.config['TIMEZONE']),
+            expires_on=expires_on,
+            **kwargs)
 
-            return ApiResponse(_build_lifecycle_state_response(ds.lifecycle[0]))
-        else:
-            raise ApiError(
-                StatusCode.InternalServerError,
-                'Dataset with EPN {} does not exist'.format(epn))
+    try:
+        state, _ = _transition_lifecycle(epn, renew)
+        return ApiResponse(_build_lifecycle_state_response(state))
     except InvalidDocumentError:
         raise ApiError(
             StatusCode.InternalServerError,
@@ -484,47 +1055,36 @@ def add_lifecycle_delete_state(epn, removed, **kwargs):
     produces:
      - application/json
     """
-    try:
-        ds = Dataset.objects(epn=epn).first()
-        if ds is not None:
-            if len(ds.lifecycle) > 0:
-                current_state = ds.lifecycle[0]
-            else:
+    def delete(ds, current_state):
+        if current_state is None:
+            raise ApiError(
+                StatusCode.InternalServerError,
+                'The dataset is not in a valid lifecycle state')
+
+        # check the current status of the dataset
+        if removed:
+            state_type = LifecycleStateType.DELETED
+            if current_state.type != LifecycleStateType.DROPPED:
                 raise ApiError(
                     StatusCode.InternalServerError,
-                    'The dataset is not in a valid lifecycle state')
-
-            # check the current status of the dataset
-            if removed:
-                state_type = LifecycleStateType.DELETED
-                if current_state.type != LifecycleStateType.DROPPED:
-                    raise ApiError(
-                        StatusCode.InternalServerError,
-                        'The dataset has to be in the {} state before it can be deleted'
-                        .format(LifecycleStateType.DROPPED))
-            else:
-                state_type = LifecycleStateType.DROPPED
-                if current_state.type == LifecycleStateType.DROPPED:
-                    raise ApiError(
-                        StatusCode.InternalServerError,
-                        'The dataset has already been marked for deletion')
+                    'The dataset has to be in the {} state before it can be deleted'
+                    .format(LifecycleStateType.DROPPED))
+        else:
+            state_type = LifecycleStateType.DROPPED
+            if current_state.type == LifecycleStateType.DROPPED:
+                raise ApiError(
+                    StatusCode.InternalServerError,
+                    'The dataset has already been marked for deletion')
 
-            ds.lifecycle.insert(
-                0,
-                LifecycleState(
-                    type=state_type,
-                    created_at=datetime.now(tz=current_app.config['TIMEZONE']),
-                    expires_on=utc_to_local(current_state.expires_on)
-                    if current_state is not None else None,
-                    **kwargs)
-            )
-            ds.save()
+        return LifecycleState(
+            type=state_type,
+            created_at=datetime.now(tz=current_app.config['TIMEZONE']),
+            expires_on=utc_to_local(current_state.expires_on),
+            **kwargs)
 
-            return ApiResponse(_build_lifecycle_state_response(ds.lifecycle[0]))
-        else:
-            raise ApiError(
-                StatusCode.InternalServerError,
-                'Dataset with EPN {} does not exist'.format(epn))
+    try:
+        state, _ = _transition_lifecycle(epn, delete)
+        return ApiResponse(_build_lifecycle_state_response(state))
     except InvalidDocumentError:
         raise ApiError(
             StatusCode.InternalServerError,
@@ -544,52 +1104,71 @@ def update_lifecycle_expiry_state(epn):
     produces:
      - application/json
     """
-    try:
-        ds = Dataset.objects(epn=epn).first()
-        if ds is not None:
-            # check that the dataset is in a state in which it can be expired
-            if len(ds.lifecycle) == 0:
-                raise ApiError(
-                    StatusCode.InternalServerError,
-                    'Cannot expire a dataset that has no lifecycle state yet')
-
-            current_state = ds.lifecycle[0]
-
-            # check that the dataset is not excluded and in the correct state
-            changed_to_expired = False
-            if (not _is_dataset_excluded(ds.visit, ds.policy)) and\
-                    (current_state.type in [LifecycleStateType.NORMAL,
-                                            LifecycleStateType.RENEWED]):
-
-                # check whether it has expired
-                if datetime.now(tz=current_app.config['TIMEZONE']) > \
-                        utc_to_local(current_state.expires_on):
-
-                    changed_to_expired = True
-                    ds.lifecycle.insert(
-                        0,
-                        LifecycleState(
-                            type=LifecycleStateType.EXPIRED,
-                            created_at=datetime.now(tz=current_app.config['TIMEZONE']),
-                            expires_on=utc_to_local(current_state.expires_on),
-                            user_id=None,
-                            user_name='auto',
-                            notes='auto generated during expiry date update')
-                    )
-                    ds.save()
-
-            return ApiResponse({**_build_lifecycle_state_response(ds.lifecycle[0]),
-                                **{'changed': changed_to_expired}})
-        else:
+    def expire(ds, current_state):
+        # check that the dataset is in a state in which it can be expired
+        if current_state is None:
             raise ApiError(
                 StatusCode.InternalServerError,
-                'Dataset with EPN {} does not exist'.format(epn))
+                'Cannot expire a dataset that has no lifecycle state yet')
+
+        # check that the dataset is not excluded and in the correct state
+        if (not is_dataset_excluded(ds.visit, policy_cache.get_for_dataset(ds))) and\
+                (current_state.type in [LifecycleStateType.NORMAL,
+                                        LifecycleStateType.RENEWED]):
+
+            # check whether it has expired, datasets without an expiry date never expire
+            if (current_state.expires_on is not None) and\
+                    (datetime.now(tz=current_app.config['TIMEZONE']) >
+                     utc_to_local(current_state.expires_on)):
+
+                return LifecycleState(
+                    type=LifecycleStateType.EXPIRED,
+                    created_at=datetime.now(tz=current_app.config['TIMEZONE']),
+                    expires_on=utc_to_local(current_state.expires_on),
+                    user_id=None,
+                    user_name='auto',
+                    notes='auto generated during expiry date update')
+        return None
+
+    try:
+        state, changed_to_expired = _transition_lifecycle(epn, expire)
+        return ApiResponse({**_build_lifecycle_state_response(state),
+                            **{'changed': changed_to_expired}})
     except InvalidDocumentError:
         raise ApiError(
             StatusCode.InternalServerError,
             'The dataset for EPN {} seems to be damaged'.format(epn))
 
 
+@api.route('/lifecycle/sweep', methods=['POST'])
+@dataschema(Schema({
+    'dry_run': Boolean()
+}, extra=REMOVE_EXTRA))
+def expire_datasets_endpoint(dry_run=False):
+    """
+    Transition all datasets whose expiry date has passed to the expired state
+
+    Only datasets that are not excluded from their policy and are in the normal or
+    renewed state are expired. Datasets whose lifecycle changes during the sweep are
+    skipped.
+
+    ---
+    tags:
+     - Lifecycle
+    produces:
+     - application/json
+    parameters:
+     - name: dry_run
+       in: query
+       type: boolean
+       description: Only return the datasets that would be expired, without changing them.
+    """
+    report = expire_datasets(dry_run=dry_run)
+    return ApiResponse({**report,
+                        'expired_count': len(report['expired']),
+                        'skipped_count': len(report['skipped'])})
+
+
 @api.route('/<epn>/lifecycle', methods=['GET'])
 def retrieve_lifecycle_details(epn):
     """
@@ -633,11 +1212,16 @@ def retrieve_lifecycle_last(epn):
     produces:
      - application/json
     """
+    not_modified = _not_modified(epn)
+    if not_modified is not None:
+        return not_modified
+
     try:
-        ds = Dataset.objects(epn=epn).first()
+        ds = Dataset.objects(epn=epn).only('revision').fields(slice__lifecycle=1).first()
         if ds is not None:
             return ApiResponse(_build_lifecycle_state_response(ds.lifecycle[0])
-                               if len(ds.lifecycle) > 0 else {})
+                               if len(ds.lifecycle) > 0 else {},
+                               headers={'ETag': _etag_header(ds.id, ds.revision)})
         else:
             raise ApiError(
                 StatusCode.InternalServerError,
@@ -652,106 +1236,394 @@ def retrieve_lifecycle_last(epn):
 # ---------------------------------------------------------------------------------------------------------------------
 #                                             Private Functions
 # ---------------------------------------------------------------------------------------------------------------------
-def _get_visit_from_portal(epn):
-    """ Get the visit information from the User Portal and return a MongoDB visit object.
-
-    :return:
+def _new_dataset(epn, visit, policy):
+    """ Create a new, unsaved dataset for a visit in its initial lifecycle state. """
+    # Excluded experiment types don't expire
+    if is_dataset_excluded(visit, policy):
+        expiry_date = None
+    else:
+        expiry_date = visit.start_date + timedelta(days=policy.retention)
+
+    new_ds = Dataset(epn=epn, notes='',
+                     policy=policy,
+                     visit=visit,
+                     storage={},
+                     lifecycle=[LifecycleState(
+                         type=LifecycleStateType.NORMAL,
+                         created_at=datetime.now(tz=current_app.config['TIMEZONE']),
+                         expires_on=expiry_date,
+                         user_id=None,
+                         user_name='auto',
+                         notes='auto generated during dataset creation')
+                     ])
+    new_ds.summary = build_summary(new_ds, policy)
+    return new_ds
+
+
+def _save_dataset(dataset):
+    """ Update the summary of a fully loaded dataset and save it as a new revision.
+
+    The dataset is only saved if it has not been changed since it was loaded.
     """
+    revision = dataset.revision
+    dataset.summary = build_summary(dataset, policy_cache.get_for_dataset(dataset))
+    dataset.revision = (revision or 0) + 1
     try:
-        auth = Authentication(
-            client_name=current_app.config['PORTAL_SETTINGS']['client'],
-            client_password=current_app.config['PORTAL_SETTINGS']['password'],
-            url=current_app.config['PORTAL_SETTINGS']['host'],
-            verify=current_app.config['PORTAL_SETTINGS']['verify']
-        )
-        auth.login()
-    except AuthenticationFailed as e:
-        raise ApiError(StatusCode.BadRequest,
-                       'Could not connect to the User Portal: {}'.format(e))
+        dataset.save(save_condition=_revision_condition(revision))
+    except SaveConditionError:
+        raise ApiError(
+            StatusCode.Conflict,
+            'The dataset for EPN {} was modified concurrently, please try again'
+            .format(dataset.epn))
 
-    # get visit information for the specified EPN
-    portal_api = PortalAPI(auth)
 
-    try:
-        vp = portal_api.get_visit(epn, is_epn=True)
-        equipment = portal_api.get_equipment(vp.equipment_id)
+def _set_storage_event(epn, name, event):
+    """ Atomically make an event the most recent event of a storage location.
 
-    except RequestFailed as e:
+    The event replaces the previous most recent event of the location in the dataset and
+    the summary counters are adjusted by the difference between both events in a single
+    update. The update only matches if no other event was stored for the location in the
+    meantime, otherwise it is retried against the new most recent event. The event is not
+    added to the storage event history. The change is added to the usage counters of the
+    beamline and, if the quota is enforced, an event that increases the usage of a
+    beamline beyond its quota is rejected.
+
+    :return: The stored event and the beamline of the dataset.
+    """
+    event.validate()
+    collection = Dataset._get_collection()
+    path = 'storage.{}'.format(name)
+    projection = {'epn': 1, 'revision': 1, 'visit.beamline': 1, 'summary.status': 1, path: 1}
+
+    for _ in range(current_app.config['DATASET_UPDATE_RETRIES']):
+        doc = collection.find_one({'epn': epn}, projection)
+        if doc is None:
+            raise ApiError(
+                StatusCode.InternalServerError,
+                'Dataset with EPN {} does not exist'.format(epn))
+
+        _check_if_match(doc['_id'], doc.get('revision'))
+        previous = _previous_storage_event(doc, name)
+        beamline = doc.get('visit', {}).get('beamline')
+        increments = storage_summary_increments(previous, event)
+
+        if current_app.config['POLICY_QUOTA_ENFORCED'] and\
+                (increments['summary.size'] > 0) and\
+                exceeds_quota(beamline, increments['summary.size']):
+            raise ApiError(
+                StatusCode.UnprocessableEntity,
+                'The storage event would exceed the quota of the {} beamline'.format(beamline))
+
+        query = _storage_event_query(doc['_id'], name, previous)
+        if request.if_match:
+            query.update(_revision_query(doc.get('revision')))
+
+        doc = collection.find_one_and_update(
+            query,
+            _storage_event_update(name, previous, event),
+            projection=projection,
+            return_document=ReturnDocument.AFTER)
+        if doc is not None:
+            increment_usage([(beamline, doc.get('summary', {}).get('status'),
+                              increments['summary.size'], increments['summary.count'], 0)])
+            return StorageEvent._from_son(doc['storage'][name]), beamline
+
+    raise ApiError(
+        StatusCode.Conflict,
+        'The storage of the dataset for EPN {} is changing too quickly, '
+        'please try again'.format(epn))
+
+
+def _previous_storage_event(doc, name):
+    """ Return the most recent event of a storage location of a raw dataset document.
+
+    Datasets written before the storage event history was moved to its own collection
+    keep a list of events per location, which has to be migrated before new events can
+    be stored.
+    """
+    previous = doc.get('storage', {}).get(name)
+    if isinstance(previous, list):
+        raise ApiError(
+            StatusCode.InternalServerError,
+            'The storage history of the dataset for EPN {} has not been migrated yet, '
+            'please run flask migrate-storage-events'.format(doc['epn']))
+    return StorageEvent._from_son(previous) if previous is not None else None
+
+
+def _storage_event_query(dataset_id, name, previous):
+    """ Match a dataset only if the previous event is still the most recent of a location. """
+    path = 'storage.{}'.format(name)
+    if previous is None:
+        return {'_id': dataset_id, path: {'$exists': False}}
+    else:
+        return {'_id': dataset_id, '{}.created_at'.format(path): previous.created_at}
+
+
+def _storage_event_update(name, previous, event):
+    """ Replace the most recent event of a location and adjust the summary counters. """
+    return {'$set': {'storage.{}'.format(name): event.to_mongo()},
+            '$inc': {**storage_summary_increments(previous, event), 'revision': 1}}
+
+
+def _unmatched_storage_events(collection, stored):
+    """ Find the storage locations whose most recent event is not the event stored last.
+
+    :param stored: A list of tuples (dataset id, epn, name, event) of the events that were
+                   written as the most recent events of their locations.
+    :return: A list of tuples (epn, name) of the locations holding another event.
+    """
+    projection = {'storage.{}'.format(name): 1 for _, _, name, _ in stored}
+    docs = {doc['_id']: doc for doc in collection.find(
+        {'_id': {'$in': list({dataset_id for dataset_id, _, _, _ in stored})}}, projection)}
+
+    unmatched = []
+    for dataset_id, epn, name, event in stored:
+        # compare the events as stored by the database, with the precision of its dates
+        expected = decode(encode({'event': event.to_mongo()}))['event']
+        if docs.get(dataset_id, {}).get('storage', {}).get(name) != expected:
+            unmatched.append((epn, name))
+    return unmatched
+
+
+def _storage_event_record(epn, name, event):
+    """ Build the storage event history document of an event. """
+    return {**event.to_mongo(), 'epn': epn, 'name': name}
+
+
+def _add_storage_event_records(records):
+    """ Add events to the storage event history, retrying if the database fails.
+
+    The records get their ids before the first attempt, so that records written by an
+    earlier attempt are skipped as duplicates. Records that still cannot be added are
+    logged. A missing record of the most recent event of a location is restored by
+    flask migrate-storage-events.
+    """
+    for record in records:
+        record.setdefault('_id', ObjectId())
+
+    collection = StorageEventRecord._get_collection()
+    error = None
+    for _ in range(current_app.config['DATASET_UPDATE_RETRIES']):
+        try:
+            collection.insert_many(records, ordered=False)
+            return
+        except BulkWriteError as e:
+            errors = [err for err in e.details['writeErrors']
+                      if err['code'] != DUPLICATE_KEY_ERROR]
+            records = [records[err['index']] for err in errors]
+            if len(records) == 0:
+                return
+            error = errors[0]['errmsg']
+        except PyMongoError as e:
+            error = str(e)
+
+    logger.error('Could not add {} events to the storage event history ({}): {}'.format(
+        len(records), error, ', '.join('{epn}/{name} at {created_at}'.format(**record)
+                                       for record in records)))
+
+
+def _transition_lifecycle(epn, transition):
+    """ Atomically transition a dataset to a new lifecycle state.
+
+    The transition is called with the dataset, holding only its current lifecycle state,
+    and the current state, or None if there is none. It returns the new state, or None
+    if the dataset stays in its current state. The new state is pushed to the front of
+    the lifecycle and the summary is updated in a single update, which only matches if
+    the current state has not changed in the meantime. Otherwise the transition is
+    evaluated again against the state that was stored first. Datasets stored before
+    summaries were introduced get their full summary computed and stored instead.
+
+    :return: The current lifecycle state and whether it was changed by the transition.
+    """
+    collection = Dataset._get_collection()
+
+    for _ in range(current_app.config['DATASET_UPDATE_RETRIES']):
+        ds = Dataset.objects(epn=epn).only('id', 'epn', 'policy', 'visit', 'summary',
+                                           'revision').fields(slice__lifecycle=1).first()
+        if ds is None:
+            raise ApiError(
+                StatusCode.InternalServerError,
+                'Dataset with EPN {} does not exist'.format(epn))
+        _check_if_match(ds.id, ds.revision)
+
+        current_state = ds.lifecycle[0] if len(ds.lifecycle) > 0 else None
+        state = transition(ds, current_state)
+        if state is None:
+            return current_state, False
+        state.validate()
+
+        query = {'_id': ds.id}
+        if current_state is None:
+            query['lifecycle.0'] = {'$exists': False}
+        else:
+            query['lifecycle.0.type'] = current_state.type
+            query['lifecycle.0.created_at'] = current_state.created_at
+
+        if request.if_match:
+            query.update(_revision_query(ds.revision))
+
+        if ds.summary is not None:
+            query['summary'] = {'$exists': True}
+            summary_update = {'summary.status': state.type,
+                              'summary.expires_on': state.expires_on}
+        else:
+            # a partial summary would hide the missing one, so store the full summary
+            query['summary'] = {'$exists': False}
+            summary_update = {'summary': _compute_missing_summary(ds, state).to_mongo()}
+
+        doc = collection.find_one_and_update(
+            query,
+            {'$push': {'lifecycle': {'$each': [state.to_mongo()], '$position': 0}},
+             '$set': summary_update,
+             '$inc': {'revision': 1}},
+            projection={'epn': 1, 'summary': 1, 'lifecycle': {'$slice': 1}},
+            return_document=ReturnDocument.AFTER)
+        if doc is not None:
+            summary = doc.get('summary', {})
+            increment_usage(move_usage(
+                ds.visit.beamline, current_state.type if current_state is not None else None,
+                state.type, summary.get('size', 0), summary.get('count', 0)))
+            return LifecycleState._from_son(doc['lifecycle'][0]), True
+
+    raise ApiError(
+        StatusCode.Conflict,
+        'The lifecycle of the dataset for EPN {} is changing too quickly, '
+        'please try again'.format(epn))
+
+
+def _etag_header(dataset_id, revision):
+    return '"{}"'.format(_dataset_etag(dataset_id, revision))
+
+
+def _dataset_etag(dataset_id, revision):
+    """ Build the entity tag of a dataset, which changes with every write to the dataset. """
+    return '{}.{}'.format(dataset_id, revision or 0)
+
+
+def _dataset_etags(dataset_id, revision):
+    """ Return the entity tags of the uncompressed and compressed representations of a
+    dataset in its current revision, see toolset.response. """
+    etag = _dataset_etag(dataset_id, revision)
+    return [etag, etag + GZIP_ETAG_SUFFIX]
+
+
+def _not_modified(epn):
+    """ Answer a conditional GET with 'Not Modified' if the dataset has not changed.
+
+    Only the revision of the dataset is read from the database.
+
+    :return: The response, or None if the request is not conditional or the dataset changed.
+    """
+    if not request.if_none_match:
+        return None
+
+    doc = Dataset._get_collection().find_one({'epn': epn}, {'revision': 1})
+    if doc is None:
+        return None
+
+    for etag in _dataset_etags(doc['_id'], doc.get('revision')):
+        if request.if_none_match.contains_weak(etag):
+            return ApiResponse(None, StatusCode.NotModified, headers={'ETag': '"{}"'.format(etag)})
+    return None
+
+
+def _check_if_match(dataset_id, revision):
+    """ Reject a conditional write if the dataset is not in the expected revision. """
+    if request.if_match and not any(request.if_match.contains(etag)
+                                    for etag in _dataset_etags(dataset_id, revision)):
+        raise ApiError(
+            StatusCode.PreconditionFailed,
+            'The dataset has been modified since it was retrieved')
+
+
+def _revision_query(revision):
+    """ Match a dataset only if it is still in the given revision. """
+    return {'revision': revision} if revision else {'revision': {'$in': [0, None]}}
+
+
+def _revision_condition(revision):
+    """ The same condition as _revision_query, for a mongoengine query or save condition. """
+    return {'revision': revision} if revision else {'revision__in': [0, None]}
+
+
+def _parse_dataset_fields(fields):
+    """ Turn the comma separated 'fields' parameter into a list of response keys. """
+    if fields is None:
+        return None
+
+    fields = [f.strip() for f in fields.split(',') if f.strip()]
+    unknown = [f for f in fields if f not in DATASET_RESPONSE_FIELDS]
+    if len(unknown) > 0:
         raise ApiError(StatusCode.BadRequest,
-                       'An error occurred when contacting the User Portal: {}'.format(e))
-
-    # create a MongoDB Engine Visit object
-    return Visit(
-        id=vp.id,
-        start_date=vp.start_time,
-        end_date=vp.end_time,
-        title=vp.proposal.title,
-        beamline=equipment.name_short,
-        type=VisitType(
-            id=vp.proposal.type.id,
-            name_short=vp.proposal.type.name_short,
-            name_long=vp.proposal.type.name_long
-        ),
-        pi=PrincipalInvestigator(
-            id=vp.principal_scientist.id,
-            first_names=vp.principal_scientist.first_names,
-            last_name=vp.principal_scientist.last_name,
-            email=vp.principal_scientist.email,
-            org=Organisation(
-                id=vp.principal_scientist.organisation.id,
-                name_short=vp.principal_scientist.organisation.name_short,
-                name_long=vp.principal_scientist.organisation.name_long
-            )
-        )
-    )
-
-
-def _is_dataset_excluded(visit, policy):
-    return (visit.type.id in policy.exclude_type) or\
-           (visit.pi.org.id in policy.exclude_org)
-
-
-def _build_dataset_response(dataset):
-    storage_items = []
-    for name, event in dataset.storage.items():
-        last_event = event[0]
-        storage_items.append({
-            'available': (last_event.size is not None) and
-                         (last_event.count is not None) and
-                         ((not last_event.error) or
-                          (last_event.error is not None)),
-            'size': last_event.size,
-            'count': last_event.count,
-        })
+                       'Unknown dataset fields: {}'.format(', '.join(unknown)))
+    return fields
 
-    last_lifecycle_state = dataset.lifecycle[0]
-    return {
-        'epn': dataset.epn,
-        'beamline': dataset.visit.beamline,
-        'status': last_lifecycle_state.type,
-        'excluded': _is_dataset_excluded(dataset.visit, dataset.policy),
-        'expires_on':
-            utc_to_local(last_lifecycle_state.expires_on).isoformat()
-            if last_lifecycle_state.expires_on is not None else None,
-        'available':
-            all([item['available'] for item in storage_items])
-            if len(storage_items) > 0 else False,
-        'size': sum([item['size'] for item in storage_items]),
-        'count': sum([item['count'] for item in storage_items]),
-        'contact': dataset.visit.pi.email,
-        'notes': dataset.notes,
-        'visit': {
+
+def _project_dataset_fields(queryset, fields):
+    """ Restrict a dataset query to the database fields required by the response keys.
+
+    The documents returned by the query are incomplete and must never be saved.
+    """
+    paths = {path for key in (fields or DATASET_RESPONSE_FIELDS.keys())
+             for path in DATASET_RESPONSE_FIELDS[key]}
+
+    # MongoDB rejects projections that contain both a field and one of its sub-fields
+    paths = {path for path in paths
+             if not any(path.startswith(other + '.') for other in paths)}
+    return queryset.only('revision', *paths)
+
+
+def _build_dataset_response(dataset, fields=None):
+    """ Build the response for a dataset.
+
+    :param fields: The list of response keys that should be built, all keys if None.
+    """
+    def wanted(*keys):
+        return (fields is None) or any(key in fields for key in keys)
+
+    local = local_time_converter()
+    response = {}
+    if wanted('available', 'size', 'count', 'status', 'expires_on', 'excluded'):
+        summary = dataset.summary
+        if summary is None:
+            summary = _compute_missing_summary(dataset)
+
+        if wanted('available'):
+            response['available'] = (summary.locations > 0) and (summary.unavailable == 0)
+        if wanted('size'):
+            response['size'] = summary.size
+        if wanted('count'):
+            response['count'] = summary.count
+        if wanted('status'):
+            response['status'] = summary.status
+        if wanted('expires_on'):
+            response['expires_on'] = local(summary.expires_on)
+        if wanted('excluded'):
+            response['excluded'] = summary.excluded
+
+    if wanted('epn'):
+        response['epn'] = dataset.epn
+    if wanted('beamline'):
+        response['beamline'] = dataset.visit.beamline
+    if wanted('contact'):
+        response['contact'] = dataset.visit.pi.email
+    if wanted('notes'):
+        response['notes'] = dataset.notes
+    if wanted('visit'):
+        response['visit'] = {
             'id': dataset.visit.id,
-            'start': utc_to_local(dataset.visit.start_date).isoformat(),
-            'end': utc_to_local(dataset.visit.end_date).isoformat(),
+            'start': local(dataset.visit.start_date),
+            'end': local(dataset.visit.end_date),
             'title': dataset.visit.title
-            },
-        'type': {
+        }
+    if wanted('type'):
+        response['type'] = {
             'id': dataset.visit.type.id,
             'name_short': dataset.visit.type.name_short,
             'name_long': dataset.visit.type.name_long
-            },
-        'pi': {
+        }
+    if wanted('pi'):
+        response['pi'] = {
             'id': dataset.visit.pi.id,
             'first_names': dataset.visit.pi.first_names,
             'last_name': dataset.visit.pi.last_name,
@@ -760,14 +1632,37 @@ def _build_dataset_response(dataset):
                 'id': dataset.visit.pi.org.id,
                 'name_short': dataset.visit.pi.org.name_short,
                 'name_long': dataset.visit.pi.org.name_long
-                }
             }
-    }
+        }
+    return response
+
+
+def _compute_missing_summary(dataset, state=None):
+    """ Compute the summary of a dataset that was stored before summaries were introduced.
+
+    The full dataset is loaded for computing the summary, which is not stored. Until the
+    summaries are backfilled, such datasets are not found by searches on summary fields.
+
+    :param state: A lifecycle state that is about to become the current state of the
+                  dataset, which the summary is computed for.
+    """
+    doc = Dataset._get_collection().find_one({'_id': dataset.id})
+    if doc is None:
+        raise ApiError(
+            StatusCode.InternalServerError,
+            'The dataset with id {} does not exist anymore'.format(dataset.id))
+
+    logger.warning('The dataset for EPN {} has no summary, please run the backfill'
+                   .format(doc['epn']))
+    if state is not None:
+        doc['lifecycle'] = [state.to_mongo()] + doc.get('lifecycle', [])
+    policy = policy_cache.get(doc['policy'].id) if doc.get('policy') is not None else None
+    return build_document_summary(doc, policy)
 
 
 def _build_storage_event_response(event):
     return {
-        'created_at': utc_to_local(event.created_at).isoformat(),
+        'created_at': local_time(event.created_at),
         'host': event.host,
         'path': event.path,
         'size': event.size,
@@ -779,10 +1674,8 @@ def _build_storage_event_response(event):
 def _build_lifecycle_state_response(state):
     return {
         'type': state.type,
-        'created_at': utc_to_local(state.created_at).isoformat(),
-        'expires_on':
-            utc_to_local(state.expires_on).isoformat()
-            if state.expires_on is not None else None,
+        'created_at': local_time(state.created_at),
+        'expires_on': local_time(state.expires_on),
         'user_id': state.user_id,
         'user_name': state.user_name,
         'notes': state.notes
@@ -0,0 +1,86 @@
+from collections import OrderedDict
+from datetime import datetime
+from flask import Blueprint, current_app
+from pymongo.errors import PyMongoError
+
+from .const import LifecycleStateType
+from app.models import Dataset
+from toolset import ApiResponse, ApiError, StatusCode
+
+
+api = Blueprint('diagnostics', __name__, url_prefix='/diagnostics')
+
+
+# representative queries for each query path of the dataset API
+QUERIES = OrderedDict([
+    ('search_beamline',
+     lambda: Dataset.objects(summary__beamline='mx1').order_by('id')),
+    ('search_status',
+     lambda: Dataset.objects(summary__status=LifecycleStateType.NORMAL).order_by('id')),
+    ('search_pi_email_prefix',
+     lambda: Dataset.objects(summary__contact__startswith='jane').order_by('id')),
+    ('search_excluded',
+     lambda: Dataset.objects(summary__excluded=True).order_by('id')),
+    ('search_expires',
+     lambda: Dataset.objects(summary__expires_on__gte=datetime(2018, 1, 1)).order_by('id')),
+    ('refresh_beamline_start',
+     lambda: Dataset.objects(summary__beamline='mx1',
+                             visit__start_date__gte=datetime(2018, 1, 1))),
+    ('search_available_size',
+     lambda: Dataset.objects(summary__unavailable=0, summary__locations__gt=0,
+                             summary__size__gte=10 ** 13).order_by('id')),
+    ('expiry',
+     lambda: Dataset.objects(
+         summary__status__in=[LifecycleStateType.NORMAL, LifecycleStateType.RENEWED],
+         summary__expires_on__lt=datetime.now(tz=current_app.config['TIMEZONE']),
+         summary__excluded=False))
+])
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+#                                               Diagnostics API
+# ---------------------------------------------------------------------------------------------------------------------
+@api.route('/indexes', methods=['GET'])
+def explain_queries():
+    """
+    Explain the query plans chosen for the representative dataset queries
+
+    ---
+    tags:
+     - Diagnostics
+    produces:
+     - application/json
+    """
+    try:
+        plans = OrderedDict()
+        for name, query in QUERIES.items():
+            winning_plan = query().explain()['queryPlanner']['winningPlan']
+            # newer servers wrap the plan of the slot based execution engine
+            winning_plan = winning_plan.get('queryPlan', winning_plan)
+            stages = _collect_stages(winning_plan)
+            plans[name] = {
+                'stages': [stage['stage'] for stage in stages],
+                'indexes': [stage['indexName'] for stage in stages if 'indexName' in stage],
+                'collection_scan': any(stage['stage'] == 'COLLSCAN' for stage in stages)
+            }
+
+        return ApiResponse({
+            'indexes': sorted(Dataset._get_collection().index_information().keys()),
+            'queries': plans
+        })
+    except PyMongoError as e:
+        raise ApiError(StatusCode.InternalServerError,
+                       'Could not explain the dataset queries: {}'.format(e))
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+#                                             Private Functions
+# ---------------------------------------------------------------------------------------------------------------------
+def _collect_stages(plan):
+    """ Flatten a query plan into the list of its stages, from the root to the leaves. """
+    stages = [plan]
+    if 'inputStage' in plan:
+        stages.extend(_collect_stages(plan['inputStage']))
+    for input_stage in plan.get('inputStages', []):
+        stages.extend(_collect_stages(input_stage))
+    return stages
@@ -0,0 +1,57 @@
+from datetime import datetime
+from flask import Blueprint
+
+from .utils import local_time
+from app import scheduler
+from app.models import JobStatus
+from toolset import ApiResponse
+
+
+api = Blueprint('jobs', __name__, url_prefix='/jobs')
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+#                                                   Jobs API
+# ---------------------------------------------------------------------------------------------------------------------
+@api.route('', methods=['GET'])
+def retrieve_jobs():
+    """
+    Retrieve the status of the scheduled maintenance jobs
+
+    The status of a job is shared by all service processes and reflects the last run
+    of the job by any of them.
+
+    ---
+    tags:
+     - Jobs
+    produces:
+     - application/json
+    """
+    statuses = {job.name: job for job in JobStatus.objects(name__in=scheduler.jobs)}
+    now = datetime.utcnow()
+
+    return ApiResponse({
+        'enabled': bool(scheduler.enabled),
+        'jobs': [_build_job_response(name, statuses.get(name), now) for name in scheduler.jobs]
+    })
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+#                                             Private Functions
+# ---------------------------------------------------------------------------------------------------------------------
+def _build_job_response(name, status, now):
+    if status is None:
+        status = JobStatus(name=name)
+
+    return {
+        'name': name,
+        'interval': scheduler.interval(name),
+        'running': (status.lease_until is not None) and (status.lease_until > now),
+        'next_run': local_time(status.next_run_at),
+        'last_started': local_time(status.last_started_at),
+        'last_finished': local_time(status.last_finished_at),
+        'last_duration': status.last_duration,
+        'last_processed': status.last_processed,
+        'last_error': status.last_error,
+        'runs': status.runs
+    }
@@ -1,7 +1,8 @@
-from flask import Blueprint
+from flask import Blueprint, Response, current_app
 
 from app.version import __version__
-from toolset import ApiResponse
+from toolset import ApiResponse, ApiError, StatusCode
+from toolset.metrics import CONTENT_TYPE
 
 
 api = Blueprint('main', __name__)
@@ -12,3 +13,24 @@ def info():
     return ApiResponse({
         'version': __version__
     })
+
+
+@api.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Return the metrics of the service in the Prometheus text exposition format
+
+    Includes the latency of the requests per endpoint and status, the number of requests
+    in flight, the time spent serialising responses, in requests to the User Portal and
+    in MongoDB commands.
+
+    ---
+    tags:
+     - Main
+    produces:
+     - text/plain
+    """
+    if not current_app.metrics_enabled:
+        raise ApiError(StatusCode.NotFound, 'Metrics are disabled')
+
+    return Response(current_app.metrics.render(), content_type=CONTENT_TYPE)
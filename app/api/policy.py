@@ -2,7 +2,10 @@ from flask import Blueprint
 from voluptuous import Schema, Required, Optional, Coerce, REMOVE_EXTRA
 from mongoengine.errors import NotUniqueError, InvalidDocumentError, OperationError
 
+from app.cache import policy_cache
 from app.models import Policy
+from app.summary import update_policy_summaries
+from app.usage import usage_cache, build_usage_report
 from toolset.decorators import dataschema
 from toolset import ApiResponse, ApiError, StatusCode
 
@@ -26,6 +29,7 @@ def create_policy(beamline, **kwargs):
     try:
         new_pl = Policy(beamline=beamline, **kwargs)
         new_pl.save()
+        policy_cache.invalidate()
         return ApiResponse(_build_policy_response(new_pl))
     except NotUniqueError:
         raise ApiError(StatusCode.BadRequest,
@@ -43,6 +47,49 @@ def retrieve_all_policies():
                 'One of the policies seems to be damaged')
 
 
+@api.route('/usage', methods=['GET'])
+def retrieve_all_usage():
+    """
+    Retrieve the storage usage of all beamlines compared to their quota
+
+    The usage is aggregated over the most recent storage events of all datasets, broken
+    down by lifecycle status. Deleted datasets don't count towards the quota. The result
+    is cached for a short time.
+
+    ---
+    tags:
+     - Policy
+    produces:
+     - application/json
+    """
+    usage = usage_cache.all()
+    quotas = {pl.beamline: pl.quota for pl in policy_cache.all()}
+    return ApiResponse({'usage': [
+        build_usage_report(beamline, usage.get(beamline, {}), quotas.get(beamline))
+        for beamline in sorted(set(quotas) | {bl for bl in usage if bl is not None})
+    ]})
+
+
+@api.route('/<beamline>/usage', methods=['GET'])
+def retrieve_usage(beamline):
+    """
+    Retrieve the storage usage of a beamline compared to its quota
+
+    ---
+    tags:
+     - Policy
+    produces:
+     - application/json
+    """
+    pl = policy_cache.get_by_beamline(beamline)
+    if pl is None:
+        raise ApiError(
+            StatusCode.InternalServerError,
+            'A policy for {} does not exist'.format(beamline))
+
+    return ApiResponse(build_usage_report(beamline, usage_cache.get(beamline), pl.quota))
+
+
 @api.route('/<beamline>', methods=['GET'])
 def retrieve_policy(beamline):
     try:
@@ -75,6 +122,12 @@ def update_policy(beamline, **kwargs):
                 setattr(pl, key, value)
 
             pl.save()
+            policy_cache.invalidate()
+
+            # changes to the exclusion rules change the summary of the datasets
+            if ('exclude_type' in kwargs) or ('exclude_org' in kwargs):
+                update_policy_summaries(pl)
+
             return ApiResponse(_build_policy_response(pl))
         else:
             raise ApiError(
@@ -92,6 +145,7 @@ def delete_policy(beamline):
     if pl is not None:
         try:
             pl.delete()
+            policy_cache.invalidate()
         except OperationError:
             raise ApiError(
                 StatusCode.InternalServerError,
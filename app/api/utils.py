@@ -1,7 +1,123 @@
-from pytz import timezone
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as DecodeError
+from bson import ObjectId
+from bson.errors import InvalidId
+from pytz import utc
 from flask import current_app
+from portalapi.exceptions import AuthenticationFailed, RequestFailed
+
+from app import portal
+from app.models import Visit, VisitType, PrincipalInvestigator, Organisation
+from toolset import ApiError, StatusCode
+from toolset.serializer import LocalTimeFormatter
+
+
+# the formatters of local_time by timezone, which cache the offset of every day
+_local_time_formatters = {}
 
 
 def utc_to_local(utc_datetime):
-    return utc_datetime.replace(tzinfo=timezone('UTC'))\
-        .astimezone(current_app.config['TIMEZONE'])
+    if utc_datetime is None:
+        return None
+    return utc_datetime.replace(tzinfo=utc).astimezone(current_app.config['TIMEZONE'])
+
+
+def local_time(value):
+    """ Convert a datetime of the database into the timezone of the service for a response.
+
+    The conversion is cheaper than utc_to_local and yields datetimes that the serialiser
+    writes without calling back into Python, see toolset.serializer.
+    """
+    return local_time_converter()(value)
+
+
+def local_time_converter():
+    """ Return the function behind local_time, for converting many datetimes at once. """
+    tz = current_app.config['TIMEZONE']
+    formatter = _local_time_formatters.get(tz)
+    if formatter is None:
+        formatter = _local_time_formatters[tz] = LocalTimeFormatter(tz)
+    return formatter.localize
+
+
+def encode_cursor(object_id):
+    """ Turn the id of the last document of a page into an opaque pagination cursor. """
+    return urlsafe_b64encode(object_id.binary).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """ Return the document id encoded in a pagination cursor. """
+    try:
+        return ObjectId(urlsafe_b64decode(cursor.encode('ascii')))
+    except (DecodeError, InvalidId, UnicodeEncodeError, TypeError):
+        raise ApiError(StatusCode.BadRequest, 'Invalid pagination cursor')
+
+
+def get_visit_from_portal(epn, fresh=False):
+    """ Get the visit information from the User Portal and return a MongoDB visit object.
+
+    :param fresh: Bypass the portal cache and request the latest information.
+    :return:
+    """
+    try:
+        vp = portal.get_visit(epn, fresh=fresh)
+        equipment = portal.get_equipment(vp.equipment_id, fresh=fresh)
+
+    except (AuthenticationFailed, RequestFailed) as e:
+        raise _portal_error(e)
+
+    return _build_visit(vp, equipment)
+
+
+def get_visits_from_portal(epns, fresh=False, throttle=None):
+    """ Get the visit information of many EPNs from the User Portal.
+
+    The visits are fetched concurrently and the equipment of the visits is only
+    requested once per batch, see Portal.get_visits.
+
+    :param fresh: Bypass the portal cache and request the latest information.
+    :param throttle: Callable that is invoked before the visit of every EPN is requested.
+    :return: A generator of tuples (epn, visit) in the order the visits arrive. The visit
+             is a MongoDB visit object, or the ApiError describing why it could not be
+             retrieved.
+    """
+    for epn, result in portal.get_visits(epns, fresh=fresh, throttle=throttle):
+        if isinstance(result, Exception):
+            yield epn, _portal_error(result)
+        else:
+            yield epn, _build_visit(*result)
+
+
+def _portal_error(error):
+    if isinstance(error, AuthenticationFailed):
+        return ApiError(StatusCode.BadRequest,
+                        'Could not connect to the User Portal: {}'.format(error))
+    return ApiError(StatusCode.BadRequest,
+                    'An error occurred when contacting the User Portal: {}'.format(error))
+
+
+def _build_visit(vp, equipment):
+    """ Create a MongoDB Engine Visit object from a portal visit and its equipment. """
+    return Visit(
+        id=vp.id,
+        start_date=vp.start_time,
+        end_date=vp.end_time,
+        title=vp.proposal.title,
+        beamline=equipment.name_short,
+        type=VisitType(
+            id=vp.proposal.type.id,
+            name_short=vp.proposal.type.name_short,
+            name_long=vp.proposal.type.name_long
+        ),
+        pi=PrincipalInvestigator(
+            id=vp.principal_scientist.id,
+            first_names=vp.principal_scientist.first_names,
+            last_name=vp.principal_scientist.last_name,
+            email=vp.principal_scientist.email,
+            org=Organisation(
+                id=vp.principal_scientist.organisation.id,
+                name_short=vp.principal_scientist.organisation.name_short,
+                name_long=vp.principal_scientist.organisation.name_long
+            )
+        )
+    )
@@ -0,0 +1,76 @@
+import time
+import threading
+from flask import current_app
+
+from app.models import Policy, CacheVersion
+
+
+class PolicyCache:
+    """ In-process cache of all policies, indexed by id and by beamline.
+
+    Policies are few and small, so they are loaded all at once. Every write to a
+    policy increments a version stamp stored in MongoDB, which is checked at most once
+    per POLICY_CACHE_CHECK_INTERVAL seconds in order to pick up changes made by other
+    workers. The cached documents are shared between threads and must not be modified.
+    """
+
+    NAME = 'policy'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_id = {}
+        self._by_beamline = {}
+        self._version = None
+        self._checked_at = 0.0
+
+    def get(self, policy_id):
+        """ Return the policy with the given id or None if it does not exist. """
+        return self._lookup(lambda: self._by_id.get(policy_id))
+
+    def get_by_beamline(self, beamline):
+        """ Return the policy of the given beamline or None if it does not exist. """
+        return self._lookup(lambda: self._by_beamline.get(beamline))
+
+    def get_for_dataset(self, dataset):
+        """ Return the policy of a dataset without dereferencing it from the database. """
+        # the raw field value is either a DBRef or an already dereferenced policy
+        reference = dataset._data.get('policy')
+        return self.get(reference.id) if reference is not None else None
+
+    def all(self):
+        """ Return a list of all policies. """
+        self._refresh()
+        return list(self._by_id.values())
+
+    def invalidate(self):
+        """ Mark the cached policies of all workers as outdated. """
+        CacheVersion.objects(name=PolicyCache.NAME).update_one(inc__version=1, upsert=True)
+        with self._lock:
+            self._version = None
+
+    def _lookup(self, find):
+        self._refresh()
+        result = find()
+        if result is None:
+            # the policy might have been created by another worker since the last check
+            self._refresh(force=True)
+            result = find()
+        return result
+
+    def _refresh(self, force=False):
+        with self._lock:
+            now = time.monotonic()
+            if (not force) and (self._version is not None) and\
+                    (now - self._checked_at < current_app.config['POLICY_CACHE_CHECK_INTERVAL']):
+                return
+
+            version = CacheVersion.objects(name=PolicyCache.NAME).scalar('version').first() or 0
+            self._checked_at = now
+            if version != self._version:
+                policies = list(Policy.objects())
+                self._by_id = {pl.id: pl for pl in policies}
+                self._by_beamline = {pl.beamline: pl for pl in policies}
+                self._version = version
+
+
+policy_cache = PolicyCache()
@@ -0,0 +1,116 @@
+import click
+from dateutil import parser
+from flask import current_app
+from flask.cli import with_appcontext
+
+from app.api.const import LifecycleStateType
+from app.jobs import (refresh_visits, backfill_summaries, migrate_storage_events,
+                      expire_datasets, reconcile_usage)
+
+
+def _local_datetime(value):
+    return current_app.config['TIMEZONE'].localize(parser.parse(value))\
+        if value is not None else None
+
+
+@click.command('refresh-visits')
+@click.option('--beamline', default=None, help='Only refresh datasets of this beamline.')
+@click.option('--status', default=None,
+              type=click.Choice([LifecycleStateType.NORMAL, LifecycleStateType.EXPIRED,
+                                 LifecycleStateType.RENEWED, LifecycleStateType.DROPPED,
+                                 LifecycleStateType.DELETED]),
+              help='Only refresh datasets in this lifecycle state.')
+@click.option('--start-from', default=None,
+              help='Only refresh datasets whose visit started on or after this date.')
+@click.option('--start-to', default=None,
+              help='Only refresh datasets whose visit started on or before this date.')
+@with_appcontext
+def refresh_visits_command(beamline, status, start_from, start_to):
+    """ Refresh the visit information of datasets from the User Portal. """
+    with click.progressbar(length=0, label='Refreshing visits') as bar:
+        def progress(done, total):
+            bar.length = total
+            bar.update(1)
+
+        report = refresh_visits(beamline=beamline, status=status,
+                                start_from=_local_datetime(start_from),
+                                start_to=_local_datetime(start_to),
+                                progress=progress)
+
+    click.echo('{total} datasets processed in {duration:.1f}s ({throughput:.1f}/s): '
+               '{changed} changed, {unchanged} unchanged, {failed} failed'
+               .format(**{**report, 'failed': len(report['failed'])}))
+    for failure in report['failed']:
+        click.echo('  {epn}: {message}'.format(**failure), err=True)
+
+
+@click.command('backfill-summaries')
+@with_appcontext
+def backfill_summaries_command():
+    """ Recompute the summary of every dataset from its full history. """
+    with click.progressbar(length=0, label='Backfilling summaries') as bar:
+        def progress(done, total):
+            bar.length = total
+            bar.update(1)
+
+        report = backfill_summaries(progress=progress)
+
+    click.echo('{total} datasets updated in {duration:.1f}s'.format(**report))
+
+
+@click.command('migrate-storage-events')
+@with_appcontext
+def migrate_storage_events_command():
+    """ Move the storage event histories of all datasets to the storage event collection
+    and restore missing history entries of the most recent events. """
+    with click.progressbar(length=0, label='Migrating storage events') as bar:
+        def progress(done, total):
+            bar.length = total
+            bar.update(1)
+
+        report = migrate_storage_events(progress=progress)
+
+    click.echo('{total} datasets processed in {duration:.1f}s: '
+               '{events} events of {migrated} datasets migrated, '
+               '{restored} missing events restored'.format(**report))
+
+
+@click.command('expire-datasets')
+@click.option('--dry-run', is_flag=True, help='Only list the datasets that would expire.')
+@with_appcontext
+def expire_datasets_command(dry_run):
+    """ Transition all datasets whose expiry date has passed to the expired state. """
+    report = expire_datasets(dry_run=dry_run)
+
+    for epn in report['expired']:
+        click.echo(epn)
+    click.echo('{expired} of {total} datasets {action} in {duration:.1f}s, {skipped} skipped'
+               .format(**{**report,
+                          'expired': len(report['expired']),
+                          'skipped': len(report['skipped']),
+                          'action': 'would expire' if dry_run else 'expired'}), err=True)
+
+
+@click.command('reconcile-usage')
+@click.option('--dry-run', is_flag=True, help='Only report the drift of the usage counters.')
+@with_appcontext
+def reconcile_usage_command(dry_run):
+    """ Correct the usage counters of all beamlines and report their drift. """
+    report = reconcile_usage(dry_run=dry_run)
+
+    for drift in report['drift']:
+        click.echo('{beamline} {status} {key}: expected {expected}, counted {actual}'
+                   .format(**drift))
+    for counter in report['skipped']:
+        click.echo('{beamline} {status} {key}: skipped, the counter is changing'
+                   .format(**counter))
+    click.echo('{beamlines} beamlines {action} in {duration:.1f}s, {drift} differences, '
+               '{skipped} skipped'
+               .format(**{**report,
+                          'drift': len(report['drift']),
+                          'skipped': len(report['skipped']),
+                          'action': 'checked' if dry_run else 'reconciled'}), err=True)
+
+
+commands = [refresh_visits_command, backfill_summaries_command, migrate_storage_events_command,
+            expire_datasets_command, reconcile_usage_command]
@@ -0,0 +1,117 @@
+""" In-process stand-in for the User Portal, for load testing and offline development.
+
+The stand-in is used instead of the User Portal if PORTAL_HOST is a URL with the scheme
+'fake'. It serves synthetic visits for any EPN and is configured by the query string of
+the URL, for example fake://?latency=0.05&error_rate=0.01&token_lifetime=300:
+
+    latency         Seconds every call to the portal takes (default 0).
+    jitter          Random extra seconds added to the latency of every call (default 0).
+    error_rate      Fraction of the calls that fail with RequestFailed (default 0).
+    token_lifetime  Seconds after which a login token is rejected, 0 for never (default 0).
+    beamlines       Comma separated names of the beamlines visits are spread across
+                    (default BL00 to BL09).
+    seed            Seed of the random generator of the jitter and errors (default 0).
+
+The visit of an EPN is derived from a checksum of the EPN, so that the same EPN always
+returns the same visit.
+"""
+import time
+import uuid
+import zlib
+import random
+import threading
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs
+from portalapi.exceptions import AuthenticationFailed, RequestFailed
+
+
+FAKE_SCHEME = 'fake'
+
+DEFAULT_BEAMLINES = ['BL{:02d}'.format(index) for index in range(10)]
+
+
+def is_fake_portal(url):
+    """ Check whether a portal URL points at the stand-in. """
+    return urlparse(url or '').scheme == FAKE_SCHEME
+
+
+class FakePortalSettings:
+    """ The behaviour of the stand-in, parsed from the query string of its URL. """
+
+    def __init__(self, url):
+        query = {key: values[-1] for key, values in parse_qs(urlparse(url).query).items()}
+        self.latency = float(query.get('latency', 0))
+        self.jitter = float(query.get('jitter', 0))
+        self.error_rate = float(query.get('error_rate', 0))
+        self.token_lifetime = float(query.get('token_lifetime', 0))
+        self.beamlines = [name for name in query.get('beamlines', '').split(',') if name] or\
+            DEFAULT_BEAMLINES
+        self._random = random.Random(int(query.get('seed', 0)))
+        self._lock = threading.Lock()
+
+    def call(self, name):
+        """ Simulate the latency of a call and fail it at the configured error rate. """
+        with self._lock:
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            failed = self._random.random() < self.error_rate
+
+        if delay > 0:
+            time.sleep(delay)
+        if failed:
+            raise RequestFailed('The fake portal failed the {} request'.format(name))
+
+
+class FakeAuthentication:
+    """ Stand-in for portalapi.Authentication. """
+
+    def __init__(self, client_name, client_password, url, verify=True):
+        self.settings = FakePortalSettings(url)
+        self.token = None
+        self.expires_at = 0.0
+
+    def login(self):
+        self.settings.call('login')
+        self.token = uuid.uuid4().hex
+        self.expires_at = time.monotonic() + self.settings.token_lifetime\
+            if self.settings.token_lifetime > 0 else float('inf')
+
+
+class FakePortalAPI:
+    """ Stand-in for portalapi.PortalAPI, serving synthetic visits and equipment. """
+
+    def __init__(self, auth):
+        self._auth = auth
+
+    def get_visit(self, epn, is_epn=True):
+        self._call('visit')
+        number = zlib.crc32(str(epn).encode('utf-8'))
+        start = datetime(2018, 1, 1) + timedelta(hours=number % (5 * 365 * 24))
+        return SimpleNamespace(
+            id=number % 1000000,
+            start_time=start,
+            end_time=start + timedelta(days=1 + number % 3),
+            equipment_id=number % len(self._auth.settings.beamlines),
+            proposal=SimpleNamespace(
+                title='Synthetic visit {}'.format(epn),
+                type=SimpleNamespace(id=number % 10, name_short='T{}'.format(number % 10),
+                                     name_long='Proposal type {}'.format(number % 10))),
+            principal_scientist=SimpleNamespace(
+                id=number % 1000, first_names='Jane', last_name='Doe',
+                email='pi{}@example.org'.format(number % 1000),
+                organisation=SimpleNamespace(
+                    id=number % 50, name_short='ORG{}'.format(number % 50),
+                    name_long='Organisation {}'.format(number % 50))))
+
+    def get_equipment(self, equipment_id):
+        self._call('equipment')
+        beamlines = self._auth.settings.beamlines
+        if not 0 <= equipment_id < len(beamlines):
+            raise RequestFailed('The equipment {} does not exist'.format(equipment_id))
+        return SimpleNamespace(id=equipment_id, name_short=beamlines[equipment_id],
+                               name_long='Beamline {}'.format(beamlines[equipment_id]))
+
+    def _call(self, name):
+        if (self._auth.token is None) or (time.monotonic() >= self._auth.expires_at):
+            raise AuthenticationFailed('The token has expired')
+        self._auth.settings.call(name)
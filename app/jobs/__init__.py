@@ -0,0 +1,9 @@
+from .visits import refresh_visits
+from .summary import backfill_summaries
+from .storage import migrate_storage_events, apply_storage_retention
+from .expiry import expire_datasets
+from .usage import reconcile_usage
+from .scheduled import scheduled_jobs
+
+__all__ = ['refresh_visits', 'backfill_summaries', 'migrate_storage_events',
+           'apply_storage_retention', 'expire_datasets', 'reconcile_usage', 'scheduled_jobs']
@@ -0,0 +1,113 @@
+import time
+import logging
+from datetime import datetime
+from flask import current_app
+from pytz import timezone
+from pymongo import UpdateOne
+
+from app.api.const import LifecycleStateType
+from app.models import Dataset, LifecycleState
+from app.usage import increment_usage, move_usage
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+
+def expire_datasets(dry_run=False):
+    """ Transition all datasets whose expiry date has passed to the expired state.
+
+    The datasets are selected with a single query on their summary, which only matches
+    datasets that are not excluded from their policy and are in the normal or renewed
+    state. The expired states are pushed with bulk updates that are conditional on the
+    current lifecycle state, so datasets that were changed in the meantime are skipped.
+
+    :param dry_run: Only select the datasets that would be expired, without changing them.
+    :return: A dictionary with the EPNs of the expired and skipped datasets, the number of
+             selected datasets and the duration.
+    """
+    started = time.monotonic()
+    now = datetime.now(tz=current_app.config['TIMEZONE'])
+    collection = Dataset._get_collection()
+
+    candidates = list(collection.find(
+        {'summary.status': {'$in': [LifecycleStateType.NORMAL, LifecycleStateType.RENEWED]},
+         'summary.expires_on': {'$lt': now},
+         'summary.excluded': False,
+         'lifecycle.0': {'$exists': True}},
+        {'epn': 1, 'visit.beamline': 1, 'summary': 1, 'lifecycle': {'$slice': 1}}))
+
+    expired = []
+    skipped = []
+    if dry_run:
+        expired = [doc['epn'] for doc in candidates]
+    else:
+        for start in range(0, len(candidates), BATCH_SIZE):
+            batch = candidates[start:start + BATCH_SIZE]
+            updates = [_expire_update(doc, now) for doc in batch]
+            matched = collection.bulk_write(updates, ordered=False).matched_count
+
+            if matched == len(batch):
+                expired_batch = batch
+            else:
+                # find the datasets whose lifecycle changed before they could be expired
+                heads = {doc['_id']: doc['lifecycle'][0] for doc in collection.find(
+                    {'_id': {'$in': [doc['_id'] for doc in batch]}},
+                    {'lifecycle': {'$slice': 1}})}
+                expired_batch = []
+                for doc in batch:
+                    head = heads.get(doc['_id'])
+                    if (head is not None) and (head['type'] == LifecycleStateType.EXPIRED) and\
+                            (head['created_at'] == _database_datetime(now)):
+                        expired_batch.append(doc)
+                    else:
+                        skipped.append(doc['epn'])
+
+            expired.extend(doc['epn'] for doc in expired_batch)
+            increment_usage(increment for doc in expired_batch
+                            for increment in _expire_usage(doc))
+
+    duration = time.monotonic() - started
+    logger.info('Expired {} of {} datasets{} in {:.1f}s'.format(
+        len(expired), len(candidates), ' (dry run)' if dry_run else '', duration))
+    return {
+        'dry_run': dry_run,
+        'total': len(candidates),
+        'expired': expired,
+        'skipped': skipped,
+        'duration': duration
+    }
+
+
+def _expire_update(doc, now):
+    """ Push the expired state onto a dataset, if its current lifecycle state is unchanged. """
+    current_state = doc['lifecycle'][0]
+    state = LifecycleState(
+        type=LifecycleStateType.EXPIRED,
+        created_at=now,
+        expires_on=current_state['expires_on'],
+        user_id=None,
+        user_name='auto',
+        notes='auto generated during expiry sweep')
+
+    return UpdateOne(
+        {'_id': doc['_id'],
+         'lifecycle.0.type': current_state['type'],
+         'lifecycle.0.created_at': current_state['created_at']},
+        {'$push': {'lifecycle': {'$each': [state.to_mongo()], '$position': 0}},
+         '$set': {'summary.status': LifecycleStateType.EXPIRED},
+         '$inc': {'revision': 1}})
+
+
+def _expire_usage(doc):
+    """ Return the usage counter increments for expiring a dataset. """
+    summary = doc.get('summary', {})
+    return move_usage(doc.get('visit', {}).get('beamline'), summary.get('status'),
+                      LifecycleStateType.EXPIRED, summary.get('size', 0), summary.get('count', 0))
+
+
+def _database_datetime(value):
+    """ Convert a datetime to the naive UTC and millisecond precision stored by MongoDB. """
+    value = value.astimezone(timezone('UTC')).replace(tzinfo=None)
+    return value.replace(microsecond=value.microsecond // 1000 * 1000)
@@ -0,0 +1,25 @@
+from collections import OrderedDict
+
+from .expiry import expire_datasets
+from .visits import refresh_visits
+from .usage import reconcile_usage
+
+
+def _expire_datasets():
+    return len(expire_datasets()['expired'])
+
+
+def _refresh_visits():
+    return refresh_visits()['total']
+
+
+def _reconcile_usage():
+    return len(reconcile_usage()['drift'])
+
+
+# the maintenance jobs run by the scheduler, each returning the number of processed items
+scheduled_jobs = OrderedDict([
+    ('expire-datasets', _expire_datasets),
+    ('refresh-visits', _refresh_visits),
+    ('reconcile-usage', _reconcile_usage)
+])
@@ -0,0 +1,122 @@
+import time
+import logging
+from pymongo import UpdateOne
+
+from app.models import Dataset, StorageEventRecord
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+RETENTION_INDEX = 'created_at_retention'
+
+
+def migrate_storage_events(progress=None):
+    """ Move the storage event histories kept inside the datasets to their own collection.
+
+    Datasets that still store a list of events per storage location are converted to
+    only keep the most recent event of each location, after all events were copied to
+    the storage event collection. Events are matched on their EPN, location and creation
+    time, so an interrupted migration can safely be run again. The most recent event of
+    every location of already migrated datasets is added to the collection if it is
+    missing, for example because adding it to the history failed.
+
+    :param progress: Callable that is invoked with the number of processed and the total
+                     number of datasets after each dataset.
+    :return: A dictionary with the number of migrated datasets and events, the number of
+             restored most recent events and the duration.
+    """
+    started = time.monotonic()
+    datasets = Dataset._get_collection()
+    events = StorageEventRecord._get_collection()
+    total = datasets.count_documents({})
+
+    event_updates = []
+    latest_updates = []
+    dataset_updates = []
+    done = migrated = copied = 0
+    restored = []
+
+    def flush():
+        # the events have to be stored before the histories are dropped from the datasets
+        if len(event_updates) > 0:
+            events.bulk_write(event_updates, ordered=False)
+            event_updates.clear()
+        if len(latest_updates) > 0:
+            restored.append(events.bulk_write(latest_updates, ordered=False).upserted_count)
+            latest_updates.clear()
+        if len(dataset_updates) > 0:
+            datasets.bulk_write(dataset_updates, ordered=False)
+            dataset_updates.clear()
+
+    for doc in datasets.find({}, {'epn': 1, 'storage': 1}).batch_size(BATCH_SIZE):
+        latest = {}
+        removed = {}
+        for name, history in doc.get('storage', {}).items():
+            if not isinstance(history, list):
+                key = {'epn': doc['epn'], 'name': name, 'created_at': history.get('created_at')}
+                latest_updates.append(UpdateOne(key, {'$setOnInsert': history}, upsert=True))
+                continue
+
+            for event in history:
+                key = {'epn': doc['epn'], 'name': name, 'created_at': event.get('created_at')}
+                event_updates.append(UpdateOne(key, {'$setOnInsert': event}, upsert=True))
+            copied += len(history)
+
+            if len(history) > 0:
+                latest['storage.{}'.format(name)] = history[0]
+            else:
+                removed['storage.{}'.format(name)] = ''
+
+        if (len(latest) > 0) or (len(removed) > 0):
+            update = {'$inc': {'revision': 1}}
+            if len(latest) > 0:
+                update['$set'] = latest
+            if len(removed) > 0:
+                update['$unset'] = removed
+            dataset_updates.append(UpdateOne({'_id': doc['_id']}, update))
+            migrated += 1
+
+        if (len(event_updates) >= BATCH_SIZE) or (len(latest_updates) >= BATCH_SIZE) or\
+                (len(dataset_updates) >= BATCH_SIZE):
+            flush()
+
+        done += 1
+        if progress is not None:
+            progress(done, total)
+
+    flush()
+
+    duration = time.monotonic() - started
+    logger.info('Migrated {} storage events of {} datasets and restored {} events in {:.1f}s'
+                .format(copied, migrated, sum(restored), duration))
+    return {
+        'total': done,
+        'migrated': migrated,
+        'events': copied,
+        'restored': sum(restored),
+        'duration': duration
+    }
+
+
+def apply_storage_retention(retention):
+    """ Create, update or remove the index that expires old storage events.
+
+    :param retention: The number of days storage events are kept. Zero keeps them forever.
+    """
+    collection = StorageEventRecord._get_collection()
+    indexes = collection.index_information()
+
+    if retention <= 0:
+        if RETENTION_INDEX in indexes:
+            collection.drop_index(RETENTION_INDEX)
+        return
+
+    seconds = int(retention * 24 * 3600)
+    if RETENTION_INDEX not in indexes:
+        collection.create_index('created_at', name=RETENTION_INDEX,
+                                expireAfterSeconds=seconds, background=True)
+    elif indexes[RETENTION_INDEX].get('expireAfterSeconds') != seconds:
+        collection.database.command('collMod', collection.name,
+                                    index={'name': RETENTION_INDEX,
+                                           'expireAfterSeconds': seconds})
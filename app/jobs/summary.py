@@ -0,0 +1,52 @@
+import time
+import logging
+from pymongo import UpdateOne
+
+from app.cache import policy_cache
+from app.models import Dataset
+from app.summary import build_document_summary
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+
+def backfill_summaries(progress=None):
+    """ Recompute the summary of every dataset from its storage and lifecycle history.
+
+    Datasets that still keep their storage event history can be summarised, but their
+    history should be moved with migrate_storage_events first.
+
+    :param progress: Callable that is invoked with the number of processed and the total
+                     number of datasets after each dataset.
+    :return: A dictionary with the number of updated datasets and the duration.
+    """
+    started = time.monotonic()
+    collection = Dataset._get_collection()
+    total = collection.count_documents({})
+
+    updates = []
+    done = 0
+    for doc in collection.find({}).batch_size(BATCH_SIZE):
+        policy = policy_cache.get(doc['policy'].id) if doc.get('policy') is not None else None
+        summary = build_document_summary(doc, policy)
+        updates.append(UpdateOne({'_id': doc['_id']}, {'$set': {'summary': summary.to_mongo()},
+                                                       '$inc': {'revision': 1}}))
+        if len(updates) >= BATCH_SIZE:
+            collection.bulk_write(updates, ordered=False)
+            updates = []
+
+        done += 1
+        if progress is not None:
+            progress(done, total)
+
+    if len(updates) > 0:
+        collection.bulk_write(updates, ordered=False)
+
+    duration = time.monotonic() - started
+    logger.info('Backfilled the summaries of {} datasets in {:.1f}s'.format(done, duration))
+    return {
+        'total': done,
+        'duration': duration
+    }
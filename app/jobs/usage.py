@@ -0,0 +1,73 @@
+import time
+import logging
+from pymongo import UpdateOne
+
+from app.models import BeamlineUsage
+from app.usage import aggregate_usage, load_usage, USAGE_KEYS
+
+
+logger = logging.getLogger(__name__)
+
+
+def reconcile_usage(dry_run=False):
+    """ Correct the usage counters of all beamlines against the dataset summaries.
+
+    The usage is aggregated from scratch and compared with the incrementally maintained
+    counters. Every difference is reported as drift and corrected by adding it to the
+    counter, so that changes made by storage events and lifecycle transitions in the
+    meantime are kept. The counters are read before and after the aggregation and
+    counters that changed in between are skipped, since it is unknown whether their
+    changes are part of the aggregation. They are corrected by the next run.
+
+    :param dry_run: Only report the drift, without changing the counters.
+    :return: A dictionary with the number of beamlines, the list of differences, the list
+             of skipped counters and the duration.
+    """
+    started = time.monotonic()
+    before = load_usage()
+    expected = {beamline: statuses for beamline, statuses in aggregate_usage().items()
+                if beamline is not None}
+    actual = load_usage()
+
+    drift = []
+    skipped = []
+    requests = []
+    beamlines = sorted(set(expected) | set(actual))
+    for beamline in beamlines:
+        expected_statuses = expected.get(beamline, {})
+        actual_statuses = actual.get(beamline, {})
+        corrections = {}
+        for status in sorted(set(expected_statuses) | set(actual_statuses)):
+            for key in USAGE_KEYS:
+                expected_value = expected_statuses.get(status, {}).get(key, 0)
+                actual_value = actual_statuses.get(status, {}).get(key, 0)
+                if expected_value == actual_value:
+                    continue
+
+                counter = {'beamline': beamline, 'status': status, 'key': key}
+                if before.get(beamline, {}).get(status, {}).get(key, 0) != actual_value:
+                    skipped.append(counter)
+                    continue
+
+                drift.append({**counter, 'expected': expected_value, 'actual': actual_value})
+                corrections['statuses.{}.{}'.format(status, key)] = expected_value - actual_value
+
+        if len(corrections) > 0:
+            requests.append(UpdateOne({'beamline': beamline}, {'$inc': corrections},
+                                      upsert=True))
+
+    if (not dry_run) and (len(requests) > 0):
+        BeamlineUsage._get_collection().bulk_write(requests, ordered=False)
+
+    duration = time.monotonic() - started
+    logger.info('Reconciled the usage of {} beamlines{} in {:.1f}s, found {} differences, '
+                'skipped {} changing counters'.format(
+                    len(beamlines), ' (dry run)' if dry_run else '', duration, len(drift),
+                    len(skipped)))
+    return {
+        'dry_run': dry_run,
+        'beamlines': len(beamlines),
+        'drift': drift,
+        'skipped': skipped,
+        'duration': duration
+    }
@@ -0,0 +1,164 @@
+import time
+import logging
+from datetime import datetime
+from flask import current_app
+from pytz import timezone
+from pymongo import UpdateOne
+from mongoengine.queryset.visitor import Q
+
+from app.api.utils import get_visits_from_portal
+from app.cache import policy_cache
+from app.models import Dataset
+from app.summary import visit_summary_fields, normalise_key
+from app.usage import increment_usage, transfer_usage
+from toolset import ApiError
+from toolset.ratelimit import RateLimiter
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+
+def refresh_visits(beamline=None, status=None, start_from=None, start_to=None,
+                   progress=None):
+    """ Refresh the visit information of datasets from the User Portal.
+
+    The visits are fetched concurrently, limited to the configured number of requests
+    per second, and the equipment of the visits is requested once per distinct
+    beamline. Visits that have not changed are skipped and the changed visits are
+    written with bulk operations of up to BATCH_SIZE datasets while the refresh runs.
+    Datasets whose visit moved to another beamline are updated one by one, since their
+    policy and usage move to the new beamline as well.
+
+    :param beamline: Only refresh datasets of this beamline.
+    :param status: Only refresh datasets whose current lifecycle state has this type.
+    :param start_from: Only refresh datasets whose visit started on or after this date.
+    :param start_to: Only refresh datasets whose visit started on or before this date.
+    :param progress: Callable that is invoked with the number of processed and the total
+                     number of datasets after each dataset.
+    :return: A dictionary with the number of processed, changed, unchanged and failed
+             datasets, the duration and the throughput of the refresh.
+    """
+    started = time.monotonic()
+
+    query = Q()
+    if beamline is not None:
+        query = query & Q(summary__beamline=normalise_key(beamline))
+
+    if status is not None:
+        query = query & Q(summary__status=status)
+
+    if start_from is not None:
+        query = query & Q(visit__start_date__gte=start_from)
+
+    if start_to is not None:
+        query = query & Q(visit__start_date__lte=start_to)
+
+    datasets = list(Dataset.objects(query).only('epn', 'policy', 'visit', 'summary')
+                    .as_pymongo())
+    total = len(datasets)
+    limiter = RateLimiter(current_app.config['VISIT_REFRESH_RATE'])
+
+    by_epn = {ds['epn']: ds for ds in datasets}
+
+    collection = Dataset._get_collection()
+    updates = []
+    changed = 0
+    failed = []
+    for done, (epn, visit) in enumerate(get_visits_from_portal(
+            by_epn.keys(), fresh=True, throttle=limiter.acquire), start=1):
+        ds = by_epn[epn]
+        if isinstance(visit, ApiError):
+            failed.append({'epn': epn, 'message': visit.message})
+        elif _normalise(visit.to_mongo()) != _normalise(ds.get('visit')):
+            if visit.beamline != ds.get('visit', {}).get('beamline'):
+                error = _move_dataset(collection, ds, visit)
+                if error is None:
+                    changed += 1
+                else:
+                    failed.append({'epn': epn, 'message': error})
+            else:
+                policy = policy_cache.get(ds['policy'].id) if ds.get('policy') is not None\
+                    else policy_cache.get_by_beamline(visit.beamline)
+                updates.append(UpdateOne({'_id': ds['_id']}, {'$set': {
+                    'visit': visit.to_mongo(),
+                    **visit_summary_fields(visit, policy)
+                }, '$inc': {'revision': 1}}))
+                changed += 1
+
+        if len(updates) >= BATCH_SIZE:
+            collection.bulk_write(updates, ordered=False)
+            updates = []
+
+        if progress is not None:
+            progress(done, total)
+
+        if (done % 100 == 0) or (done == total):
+            logger.info('Refreshed {} of {} visits ({:.1f}/s)'.format(
+                done, total, done / max(time.monotonic() - started, 1e-6)))
+
+    if len(updates) > 0:
+        collection.bulk_write(updates, ordered=False)
+
+    duration = time.monotonic() - started
+    logger.info('Refreshed the visits of {} datasets in {:.1f}s: {} changed, {} failed'
+                .format(total, duration, changed, len(failed)))
+    return {
+        'total': total,
+        'changed': changed,
+        'unchanged': total - changed - len(failed),
+        'failed': failed,
+        'duration': duration,
+        'throughput': total / duration if duration > 0 else 0.0
+    }
+
+
+def _move_dataset(collection, ds, visit):
+    """ Update a dataset whose visit moved to another beamline.
+
+    The dataset gets the policy of the new beamline and its usage is moved to the new
+    beamline. The update only matches if the beamline and the usage of the dataset have
+    not changed since the dataset was read.
+
+    :return: None if the dataset was updated, otherwise the reason why it was not.
+    """
+    policy = policy_cache.get_by_beamline(visit.beamline)
+    if policy is None:
+        return 'A policy for the {} beamline does not exist'.format(visit.beamline)
+
+    old_beamline = ds.get('visit', {}).get('beamline')
+    summary = ds.get('summary') or {}
+    result = collection.update_one(
+        {'_id': ds['_id'],
+         'visit.beamline': old_beamline,
+         'summary.status': summary.get('status'),
+         'summary.size': summary.get('size'),
+         'summary.count': summary.get('count')},
+        {'$set': {'visit': visit.to_mongo(),
+                  'policy': policy.to_dbref(),
+                  **visit_summary_fields(visit, policy)},
+         '$inc': {'revision': 1}})
+    if result.matched_count == 0:
+        return 'The dataset was modified during the refresh, please try again'
+
+    increment_usage(transfer_usage(old_beamline, visit.beamline, summary.get('status'),
+                                   summary.get('size', 0), summary.get('count', 0)))
+    return None
+
+
+def _normalise(value):
+    """ Bring a visit into the form it has after a round-trip through MongoDB.
+
+    MongoDB stores datetimes as naive UTC values with millisecond precision, so
+    timezone aware datetimes are converted and truncated before visits are compared.
+    """
+    if isinstance(value, dict):
+        return {key: _normalise(item) for key, item in value.items()}
+
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone('UTC')).replace(tzinfo=None)
+        return value.replace(microsecond=value.microsecond // 1000 * 1000)
+
+    return value
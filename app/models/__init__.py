@@ -1,6 +1,11 @@
-from .dataset import (Dataset, Visit, VisitType, PrincipalInvestigator, Organisation,
-                      StorageEvent, LifecycleState)
+from .dataset import (Dataset, DatasetSummary, Visit, VisitType, PrincipalInvestigator,
+                      Organisation, StorageEvent, LifecycleState)
 from .policy import Policy
+from .storage import StorageEventRecord
+from .cache import CacheVersion
+from .job import JobStatus
+from .usage import BeamlineUsage
 
-__all__ = ['Dataset', 'Visit', 'VisitType', 'PrincipalInvestigator', 'Organisation',
-           'StorageEvent', 'LifecycleState', 'Policy']
+__all__ = ['Dataset', 'DatasetSummary', 'Visit', 'VisitType', 'PrincipalInvestigator',
+           'Organisation', 'StorageEvent', 'LifecycleState', 'StorageEventRecord', 'Policy',
+           'CacheVersion', 'JobStatus', 'BeamlineUsage']
@@ -0,0 +1,10 @@
+from mongoengine import StringField, IntField
+
+from app import db
+
+
+class CacheVersion(db.Document):
+    name = StringField(required=True, unique=True)
+    version = IntField(default=0)
+
+    meta = {'collection': 'cache_versions'}
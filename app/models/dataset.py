@@ -1,5 +1,5 @@
 from mongoengine import (EmbeddedDocumentField, ReferenceField, ListField, MapField,
-                         StringField, IntField, DateTimeField, EmailField, DENY)
+                         StringField, IntField, BooleanField, DateTimeField, EmailField, DENY)
 
 from app import db
 from app.models.policy import Policy
@@ -53,10 +53,41 @@ class LifecycleState(db.EmbeddedDocument):
     notes = StringField()
 
 
+class DatasetSummary(db.EmbeddedDocument):
+    status = StringField()
+    expires_on = DateTimeField()
+    size = IntField(default=0)
+    count = IntField(default=0)
+    locations = IntField(default=0)
+    unavailable = IntField(default=0)
+    excluded = BooleanField(default=False)
+    # lower case copies of the beamline and the PI email, searched with an index
+    beamline = StringField()
+    contact = StringField()
+
+
 class Dataset(db.Document):
     epn = StringField(required=True, unique=True)
     notes = StringField()
     policy = ReferenceField(Policy, dbref=True, reverse_delete_rule=DENY)
     visit = EmbeddedDocumentField(Visit)
-    storage = MapField(ListField(EmbeddedDocumentField(StorageEvent)))
+    storage = MapField(EmbeddedDocumentField(StorageEvent))
     lifecycle = ListField(EmbeddedDocumentField(LifecycleState))
+    summary = EmbeddedDocumentField(DatasetSummary)
+    revision = IntField(default=0)
+
+    meta = {
+        'indexes': [
+            'policy',
+            ('summary.beamline', '_id'),
+            ('summary.beamline', 'visit.start_date'),
+            ('summary.contact', '_id'),
+            ('summary.status', '_id'),
+            ('summary.excluded', '_id'),
+            ('summary.status', 'summary.expires_on'),
+            ('summary.unavailable', 'summary.size'),
+            'summary.expires_on',
+            'visit.start_date'
+        ],
+        'index_background': True
+    }
@@ -0,0 +1,18 @@
+from mongoengine import StringField, IntField, FloatField, DateTimeField
+
+from app import db
+
+
+class JobStatus(db.Document):
+    name = StringField(required=True, unique=True)
+    owner = StringField()
+    lease_until = DateTimeField()
+    next_run_at = DateTimeField()
+    last_started_at = DateTimeField()
+    last_finished_at = DateTimeField()
+    last_duration = FloatField()
+    last_processed = IntField()
+    last_error = StringField()
+    runs = IntField(default=0)
+
+    meta = {'collection': 'job_status'}
@@ -0,0 +1,22 @@
+from mongoengine import StringField, IntField, DateTimeField
+
+from app import db
+
+
+class StorageEventRecord(db.Document):
+    epn = StringField(required=True)
+    name = StringField(required=True)
+    created_at = DateTimeField(required=True)
+    host = StringField()
+    path = StringField()
+    size = IntField()
+    count = IntField()
+    error = StringField()
+
+    meta = {
+        'collection': 'storage_events',
+        'indexes': [
+            ('epn', 'name', '-created_at')
+        ],
+        'index_background': True
+    }
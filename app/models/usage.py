@@ -0,0 +1,10 @@
+from mongoengine import StringField, DictField
+
+from app import db
+
+
+class BeamlineUsage(db.Document):
+    beamline = StringField(required=True, unique=True)
+    statuses = DictField()
+
+    meta = {'collection': 'beamline_usage'}
@@ -0,0 +1,181 @@
+import logging
+import threading
+from collections import Counter
+from flask import request
+from pymongo import monitoring
+
+
+logger = logging.getLogger(__name__)
+
+# fields of a command that don't describe the query itself
+IGNORED_COMMAND_FIELDS = {'$db', 'lsid', '$clusterTime', '$readPreference', 'txnNumber',
+                          'readConcern', 'writeConcern', 'ordered', 'batchSize', 'cursor'}
+
+# commands that continue the cursor of an earlier query instead of running a new one
+CURSOR_COMMANDS = {'getMore', 'killCursors'}
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """ Records the duration of every MongoDB command in the metrics of the application.
+
+    The listener is passed to the MongoDB client, which reports the start and the end
+    of every command it sends. Durations are recorded per command and collection.
+    """
+
+    def __init__(self, metrics):
+        self._collections = {}
+        self._duration = metrics.histogram(
+            'mongodb_command_duration_seconds', 'Time spent in MongoDB commands',
+            ['command', 'collection', 'outcome'])
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self._collections[event.request_id] =\
+            collection if isinstance(collection, str) else ''
+
+    def succeeded(self, event):
+        self._record(event, 'ok')
+
+    def failed(self, event):
+        self._record(event, 'error')
+
+    def _record(self, event, outcome):
+        self._duration.observe(event.duration_micros / 1e6, event.command_name,
+                               self._collections.pop(event.request_id, ''), outcome)
+
+
+class QueryProfile:
+    """ The MongoDB commands run while serving a single request. """
+
+    def __init__(self):
+        self.queries = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+        self.streamed = False
+        self._pending = {}
+
+    def started(self, request_id, shape):
+        """ Record the start of a command. Commands without a shape count towards the
+        totals, but are never reported as repeated. """
+        self._pending[request_id] = shape
+
+    def finished(self, request_id, duration):
+        if request_id in self._pending:
+            shape = self._pending.pop(request_id)
+            self.queries += 1
+            self.duration += duration
+            if shape is not None:
+                self.shapes[shape] += 1
+
+    def repeated(self, limit):
+        """ Return the query shapes that were run more than limit times, most frequent first. """
+        return [(shape, count) for shape, count in self.shapes.most_common() if count > limit]
+
+
+class QueryProfiler(monitoring.CommandListener):
+    """ Counts and times the MongoDB commands run by every request.
+
+    MongoDB reports the commands on the thread that runs them, so the commands are
+    collected into a profile that is bound to the thread serving the request. The totals
+    are added to the response as the headers X-Db-Queries and X-Db-Time (milliseconds),
+    and a warning is logged for every query shape that was run more often than the
+    configured limit, which usually points to a query issued in a loop.
+
+    The headers of a streamed response are sent before its body is produced, so they
+    can't hold the totals. For responses streamed with stream_with_context, the commands
+    run while the response is streamed are still counted, and the totals are logged once
+    the stream has been sent instead. Commands run by other streamed responses after the
+    request has been torn down are not counted.
+
+    Profiling is enabled for all requests with DB_PROFILING='always', or only for the
+    requests sending the header X-Db-Profile with DB_PROFILING='request'.
+    """
+
+    def __init__(self, app=None):
+        self._local = threading.local()
+        self._mode = 'off'
+        self._repeat_limit = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._mode = app.config['DB_PROFILING']
+        self._repeat_limit = app.config['DB_PROFILING_REPEAT_LIMIT']
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.teardown_request(self._teardown)
+
+    def started(self, event):
+        profile = getattr(self._local, 'profile', None)
+        if profile is not None:
+            # the batches of a cursor share the shape of the query that opened the cursor
+            profile.started(event.request_id,
+                            query_shape(event.command_name, event.command)
+                            if event.command_name not in CURSOR_COMMANDS else None)
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    def _record(self, event):
+        profile = getattr(self._local, 'profile', None)
+        if profile is not None:
+            profile.finished(event.request_id, event.duration_micros / 1e6)
+
+    def _start(self):
+        if (self._mode == 'always') or\
+                ((self._mode == 'request') and ('X-Db-Profile' in request.headers)):
+            self._local.profile = QueryProfile()
+
+    def _finish(self, response):
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            return response
+
+        if response.is_streamed:
+            # keep profiling until the request is torn down after the stream has been sent
+            profile.streamed = True
+            return response
+
+        self._stop()
+        response.headers['X-Db-Queries'] = str(profile.queries)
+        response.headers['X-Db-Time'] = '{:.3f}'.format(profile.duration * 1000)
+        self._report(profile)
+        return response
+
+    def _teardown(self, exc):
+        profile = self._stop()
+        if (profile is not None) and profile.streamed:
+            logger.info('{} {} streamed its response with {} queries in {:.3f}ms'.format(
+                request.method, request.endpoint or request.path, profile.queries,
+                profile.duration * 1000))
+            self._report(profile)
+
+    def _report(self, profile):
+        for shape, count in profile.repeated(self._repeat_limit):
+            logger.warning('{} {} ran {} queries of the same shape: {}'.format(
+                request.method, request.endpoint or request.path, count, shape))
+
+    def _stop(self):
+        profile = getattr(self._local, 'profile', None)
+        self._local.profile = None
+        return profile
+
+
+def query_shape(command_name, command):
+    """ Describe a command with all values replaced by '?', keeping the collection name. """
+    def mask(value):
+        if isinstance(value, dict):
+            return '{' + ', '.join('{}: {}'.format(key, mask(item))
+                                   for key, item in value.items()) + '}'
+        if isinstance(value, (list, tuple)):
+            # lists of different lengths have the same shape
+            return '[{}]'.format(mask(value[0])) if len(value) > 0 else '[]'
+        return '?'
+
+    return '{} {} {}'.format(command_name, command.get(command_name), mask({
+        key: value for key, value in command.items()
+        if (key != command_name) and (key not in IGNORED_COMMAND_FIELDS)}))
@@ -0,0 +1,223 @@
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+from portalapi import Authentication, PortalAPI
+from portalapi.exceptions import AuthenticationFailed
+
+from app.fakeportal import is_fake_portal, FakeAuthentication, FakePortalAPI
+
+from toolset.cache import TTLCache, SingleFlight
+
+
+class Portal:
+    """ Process-wide client for the User Portal API.
+
+    A single authenticated session is shared by all requests of the process, so the
+    login round-trip and the HTTP connection pool of the underlying client are reused.
+    The token is renewed shortly before it expires and, if the portal rejects it anyway,
+    the request is retried once after logging in again. All session handling is guarded
+    by a lock, which makes the client safe to use from a multi-threaded WSGI server.
+
+    Visits and equipment are kept in size bounded caches with a time to live, and
+    concurrent lookups of the same EPN or equipment id share a single portal request.
+    Work that fans out over many EPNs is run on a bounded, process-wide thread pool.
+
+    If the host is a URL with the scheme 'fake', an in-process stand-in serving synthetic
+    visits is used instead of the User Portal, see app.fakeportal.
+
+    The duration and outcome of every portal request and the cache hit rate are
+    recorded in the metrics of the application.
+    """
+
+    def __init__(self, app=None):
+        self._settings = None
+        self._lock = threading.Lock()
+        self._auth = None
+        self._api = None
+        self._expires_at = 0.0
+        self._visits = TTLCache(maxsize=0, ttl=0)
+        self._equipment = TTLCache(maxsize=0, ttl=0)
+        self._flight = SingleFlight()
+        self._executor = None
+        self._request_duration = None
+        self._cache_lookups = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._settings = app.config['PORTAL_SETTINGS']
+        cache_settings = app.config['PORTAL_CACHE_SETTINGS']
+        self._visits = TTLCache(maxsize=cache_settings['max_size'],
+                                ttl=cache_settings['visit_ttl'])
+        self._equipment = TTLCache(maxsize=cache_settings['max_size'],
+                                   ttl=cache_settings['equipment_ttl'])
+        with self._lock:
+            self._auth = None
+            self._api = None
+            self._expires_at = 0.0
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._executor = ThreadPoolExecutor(max_workers=self._settings['workers'])
+        self._request_duration = app.metrics.histogram(
+            'portal_request_duration_seconds', 'Time spent in requests to the User Portal',
+            ['call', 'outcome'])
+        self._cache_lookups = app.metrics.counter(
+            'portal_cache_lookups_total', 'Lookups of visits and equipment in the portal cache',
+            ['call', 'result'])
+        app.extensions['portal'] = self
+
+    def get_visit(self, epn, fresh=False):
+        """ Return the visit with the given EPN from the User Portal.
+
+        :param fresh: Bypass the cache and always request the visit from the portal.
+        """
+        return self._cached(self._visits, ('visit', epn), epn,
+                            lambda api: api.get_visit(epn, is_epn=True), fresh)
+
+    def get_equipment(self, equipment_id, fresh=False):
+        """ Return the equipment (beamline) with the given id from the User Portal.
+
+        :param fresh: Bypass the cache and always request the equipment from the portal.
+        """
+        return self._cached(self._equipment, ('equipment', equipment_id), equipment_id,
+                            lambda api: api.get_equipment(equipment_id), fresh)
+
+    def get_visits(self, epns, fresh=False, throttle=None):
+        """ Return the visits with the given EPNs, together with their equipment.
+
+        The visits are requested concurrently on the thread pool, keeping at most as many
+        EPNs in flight as the pool has workers, so other work submitted to the pool is not
+        queued behind a large batch. The equipment of a visit is requested right after the
+        visit by the same worker. Every distinct equipment is only requested once per
+        batch, later visits with the same equipment wait for that request instead.
+
+        :param fresh: Bypass the cache and always request the visits and the equipment
+                      from the portal.
+        :param throttle: Callable that is invoked on the calling thread before the visit
+                         of every EPN is submitted, for example to limit the request rate.
+        :return: A generator of tuples (epn, result) in the order the visits arrive. The
+                 result is a tuple (visit, equipment), or the exception raised while
+                 requesting the visit or equipment of the EPN.
+        """
+        equipment_futures = {}
+        equipment_lock = threading.Lock()
+
+        def fetch_equipment(equipment_id):
+            with equipment_lock:
+                future = equipment_futures.get(equipment_id)
+                is_owner = future is None
+                if is_owner:
+                    future = equipment_futures[equipment_id] = Future()
+
+            if is_owner:
+                try:
+                    future.set_result(self.get_equipment(equipment_id, fresh=fresh))
+                except Exception as e:
+                    future.set_exception(e)
+            return future.result()
+
+        def fetch(epn):
+            visit = self.get_visit(epn, fresh=fresh)
+            return visit, fetch_equipment(visit.equipment_id)
+
+        remaining = iter(OrderedDict.fromkeys(epns))
+        in_flight = {}
+        while True:
+            for epn in islice(remaining, self._settings['workers'] - len(in_flight)):
+                # throttle on the calling thread, so waiting doesn't hold a worker of the pool
+                if throttle is not None:
+                    throttle()
+                in_flight[self.submit(fetch, epn)] = epn
+            if len(in_flight) == 0:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                epn = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = e
+                yield epn, result
+
+    def submit(self, fn, *args, **kwargs):
+        """ Run a function on the portal thread pool and return its future. """
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def invalidate(self):
+        """ Remove all cached visits and equipment. """
+        self._visits.invalidate()
+        self._equipment.invalidate()
+
+    def _cached(self, cache, flight_key, key, call, fresh):
+        name = flight_key[0]
+
+        def load():
+            value = self._request(name, call)
+            cache.set(key, value)
+            return value
+
+        if fresh:
+            return load()
+
+        value = cache.get(key)
+        self._cache_lookups.inc(name, 'miss' if value is None else 'hit')
+        if value is None:
+            value = self._flight.do(flight_key, load)
+        return value
+
+    def _request(self, name, call):
+        api = self._session()
+        try:
+            return self._timed(name, call, api)
+        except AuthenticationFailed:
+            # the token was rejected before its expected expiry, log in again and retry once
+            return self._timed(name, call, self._session(stale=api))
+
+    def _timed(self, name, call, *args):
+        """ Run a portal request and record its duration and outcome. """
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            result = call(*args)
+            outcome = 'ok'
+            return result
+        finally:
+            self._request_duration.observe(time.perf_counter() - started, name, outcome)
+
+    def _client_classes(self):
+        """ Return the authentication and API classes for the configured portal. """
+        if is_fake_portal(self._settings['host']):
+            return FakeAuthentication, FakePortalAPI
+        return Authentication, PortalAPI
+
+    def _session(self, stale=None):
+        """ Return an authenticated PortalAPI object, logging in if required.
+
+        :param stale: A PortalAPI object whose token got rejected by the portal. If it is
+                      still the current session, a new login is forced.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if (self._api is None) or (self._api is stale) or (now >= self._expires_at):
+                if self._auth is None:
+                    self._auth = self._client_classes()[0](
+                        client_name=self._settings['client'],
+                        client_password=self._settings['password'],
+                        url=self._settings['host'],
+                        verify=self._settings['verify']
+                    )
+
+                try:
+                    self._timed('login', self._auth.login)
+                except AuthenticationFailed:
+                    self._api = None
+                    raise
+
+                self._api = self._client_classes()[1](self._auth)
+                self._expires_at = now + max(self._settings['token_lifetime'] -
+                                             self._settings['token_refresh_margin'], 0)
+            return self._api
@@ -0,0 +1,216 @@
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError, DuplicateKeyError
+
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """ Runs registered maintenance jobs periodically on a background thread.
+
+    Every job has its own interval. Before a job is run, the scheduler acquires a lease
+    for the job in MongoDB, so that only one of all service processes runs it, even if
+    the scheduler is enabled in several replicas. The lease is renewed periodically while
+    the job runs, released when the job has finished and expires on its own if the
+    process dies while running the job.
+    The outcome of the last run of every job is stored together with the lease. A job
+    can also be triggered to run once, for example by an API request.
+
+    The thread is started with the first request served by the process, so that it is
+    not started by command line invocations of the application.
+    """
+
+    def __init__(self, app=None):
+        self._app = None
+        self._settings = None
+        self._jobs = OrderedDict()
+        self._owner = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._app = app
+        self._settings = app.config['SCHEDULER_SETTINGS']
+        if self._settings['enabled']:
+            app.before_request(self.start)
+        app.extensions['scheduler'] = self
+
+    def register(self, name, fn):
+        """ Register a job, which is run with the interval configured for its name.
+
+        :param fn: Callable without arguments that is run within an application context
+                   and returns the number of processed items.
+        """
+        self._jobs[name] = fn
+
+    def interval(self, name):
+        """ Return the interval of a job in seconds, zero if it is disabled. """
+        return self._settings['intervals'].get(name, 0)
+
+    @property
+    def enabled(self):
+        return self._settings['enabled']
+
+    @property
+    def jobs(self):
+        return list(self._jobs.keys())
+
+    def start(self):
+        """ Start the scheduler thread, if it is not running yet. """
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._loop, name='scheduler',
+                                                daemon=True)
+                self._thread.start()
+
+    def trigger(self, name, fn):
+        """ Run a job once on a background thread, independent of its interval.
+
+        The run acquires the same lease as the scheduled runs, so it is not started while
+        the job is running in any of the service processes. Its outcome is stored as the
+        last run of the job, while the time of the next scheduled run is kept.
+
+        :param fn: Callable without arguments that is run within an application context
+                   and returns the number of processed items.
+        :return: True if the job was started, False if it is already running.
+        """
+        now = datetime.utcnow()
+        if not self._acquire(name, now, due=False):
+            return False
+
+        def run():
+            try:
+                with self._app.app_context():
+                    self._execute(name, fn, now, reschedule=False)
+            except PyMongoError as e:
+                logger.warning('Could not record the run of the job {}: {}'.format(name, e))
+
+        threading.Thread(target=run, name='job-{}'.format(name), daemon=True).start()
+        return True
+
+    def stop(self):
+        """ Stop the scheduler thread after the currently running job has finished. """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            for name, fn in self._jobs.items():
+                if self._stop.is_set():
+                    break
+
+                if self.interval(name) > 0:
+                    try:
+                        with self._app.app_context():
+                            self._run(name, fn)
+                    except PyMongoError as e:
+                        logger.warning('Could not schedule the job {}: {}'.format(name, e))
+
+            self._stop.wait(self._settings['poll_interval'])
+
+    def _run(self, name, fn):
+        """ Run a job if it is due and its lease can be acquired. """
+        # MongoDB stores naive datetimes in UTC
+        now = datetime.utcnow()
+        if self._acquire(name, now, due=True):
+            self._execute(name, fn, now, reschedule=True)
+
+    def _acquire(self, name, now, due):
+        """ Acquire the lease of a job, if it is not held by a running job.
+
+        :param due: Only acquire the lease if the next run of the job is due.
+        :return: True if the lease was acquired.
+        """
+        collection = self._collection()
+        try:
+            collection.update_one({'name': name},
+                                  {'$setOnInsert': {'next_run_at': now, 'runs': 0}},
+                                  upsert=True)
+        except DuplicateKeyError:
+            # another process created the job at the same time
+            pass
+
+        query = {'name': name, '$or': [{'lease_until': None}, {'lease_until': {'$lte': now}}]}
+        if due:
+            query['next_run_at'] = {'$lte': now}
+
+        job = collection.find_one_and_update(
+            query,
+            {'$set': {'owner': self._owner,
+                      'lease_until': now + timedelta(seconds=self._settings['lease']),
+                      'last_started_at': now}},
+            return_document=ReturnDocument.AFTER)
+        return job is not None
+
+    def _execute(self, name, fn, now, reschedule):
+        """ Run a job whose lease is held by this process and release the lease.
+
+        :param reschedule: Schedule the next run of the job after its interval.
+        """
+        logger.info('Running the job {}'.format(name))
+        started = time.monotonic()
+        processed = None
+        error = None
+        finished = threading.Event()
+        heartbeat = threading.Thread(target=self._renew_lease, args=(name, finished),
+                                     name='lease-{}'.format(name), daemon=True)
+        heartbeat.start()
+        try:
+            processed = fn()
+        except Exception as e:
+            logger.exception('The job {} failed'.format(name))
+            error = str(e) or e.__class__.__name__
+        finally:
+            finished.set()
+            heartbeat.join()
+
+        status = {'lease_until': None,
+                  'last_finished_at': datetime.utcnow(),
+                  'last_duration': time.monotonic() - started,
+                  'last_processed': processed,
+                  'last_error': error}
+        if reschedule:
+            status['next_run_at'] = now + timedelta(seconds=self.interval(name))
+
+        self._collection().update_one({'name': name, 'owner': self._owner},
+                                      {'$set': status, '$inc': {'runs': 1}})
+
+    def _renew_lease(self, name, finished):
+        """ Extend the lease of a running job every third of the lease until it has finished. """
+        collection = self._collection()
+        lease = self._settings['lease']
+        while not finished.wait(lease / 3):
+            try:
+                renewed = collection.update_one(
+                    {'name': name, 'owner': self._owner, 'lease_until': {'$ne': None}},
+                    {'$set': {'lease_until': datetime.utcnow() + timedelta(seconds=lease)}})
+            except PyMongoError as e:
+                logger.warning('Could not renew the lease of the job {}: {}'.format(name, e))
+                continue
+
+            if renewed.matched_count == 0:
+                logger.warning('The job {} has lost its lease and might be run by another '
+                               'process at the same time'.format(name))
+                return
+
+    @staticmethod
+    def _collection():
+        from app.models import JobStatus
+        return JobStatus._get_collection()
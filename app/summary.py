@@ -0,0 +1,100 @@
+from mongoengine.queryset.visitor import Q
+
+from app.models import Dataset, DatasetSummary
+
+
+def is_dataset_excluded(visit, policy):
+    if policy is None:
+        return False
+    return (visit.type.id in policy.exclude_type) or\
+           (visit.pi.org.id in policy.exclude_org)
+
+
+def normalise_key(value):
+    """ Normalise a beamline or email for case-insensitive, exact matching. """
+    return value.strip().lower() if value is not None else None
+
+
+def visit_summary_fields(visit, policy):
+    """ Return the summary fields that are derived from the visit of a dataset, as a
+    dictionary of dotted paths for updating them in the database. """
+    return {
+        'summary.excluded': is_dataset_excluded(visit, policy),
+        'summary.beamline': normalise_key(visit.beamline),
+        'summary.contact': normalise_key(visit.pi.email)
+    }
+
+
+def excluded_query(policy, excluded):
+    """ Build a query matching the datasets of a policy that are, or are not, excluded. """
+    if excluded:
+        return Q(policy=policy) & (Q(visit__type__id__in=policy.exclude_type) |
+                                   Q(visit__pi__org__id__in=policy.exclude_org))
+    else:
+        return Q(policy=policy) &\
+            Q(visit__type__id__nin=policy.exclude_type) &\
+            Q(visit__pi__org__id__nin=policy.exclude_org)
+
+
+def build_summary(dataset, policy):
+    """ Compute the summary of a dataset from its storage locations and lifecycle history.
+
+    The dataset has to be fully loaded, including all storage locations and the
+    current lifecycle state.
+    """
+    summary = DatasetSummary(excluded=is_dataset_excluded(dataset.visit, policy),
+                             beamline=normalise_key(dataset.visit.beamline),
+                             contact=normalise_key(dataset.visit.pi.email))
+
+    for name, last_event in dataset.storage.items():
+        summary.locations += 1
+        summary.size += last_event.size or 0
+        summary.count += last_event.count or 0
+        if (last_event.size is None) or (last_event.count is None):
+            summary.unavailable += 1
+
+    if len(dataset.lifecycle) > 0:
+        summary.status = dataset.lifecycle[0].type
+        summary.expires_on = dataset.lifecycle[0].expires_on
+
+    return summary
+
+
+def build_document_summary(doc, policy):
+    """ Compute the summary of a dataset from its raw, fully loaded document.
+
+    Datasets written before the storage event history was moved to its own collection
+    keep a list of events per storage location, most recent first, instead of the most
+    recent event only. The summary is computed from the most recent event in both cases.
+    """
+    return build_summary(Dataset._from_son({**doc, 'storage': latest_storage_events(doc)}),
+                         policy)
+
+
+def latest_storage_events(doc):
+    """ Return the most recent event of every storage location of a raw dataset document,
+    which may still keep a list of events per location, see build_document_summary. """
+    return {name: events[0] if isinstance(events, list) else events
+            for name, events in doc.get('storage', {}).items()
+            if not (isinstance(events, list) and len(events) == 0)}
+
+
+def storage_summary_increments(previous, event):
+    """ Compute the changes of the summary counters when a storage event becomes the most
+    recent event of its location, replacing the previous most recent event, if any. """
+    def counters(ev):
+        if ev is None:
+            return 0, 0, 0, 0
+        return (ev.size or 0, ev.count or 0, 1,
+                1 if (ev.size is None) or (ev.count is None) else 0)
+
+    return {'summary.{}'.format(key): new - old for key, old, new in
+            zip(['size', 'count', 'locations', 'unavailable'], counters(previous), counters(event))}
+
+
+def update_policy_summaries(policy):
+    """ Update the excluded flag in the summaries of all datasets of a policy. """
+    for excluded in [True, False]:
+        Dataset.objects(excluded_query(policy, excluded) &
+                        Q(summary__excluded__ne=excluded)).update(
+            set__summary__excluded=excluded, inc__revision=1)
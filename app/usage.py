@@ -0,0 +1,183 @@
+import threading
+from collections import OrderedDict
+from flask import current_app
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from app.api.const import LifecycleStateType
+from app.cache import policy_cache
+from app.models import Dataset, BeamlineUsage
+from toolset.cache import TTLCache, SingleFlight
+
+
+# datasets in these states no longer occupy storage and don't count towards the quota
+RELEASED_STATES = [LifecycleStateType.DELETED]
+
+USAGE_KEYS = ['size', 'count', 'datasets']
+
+
+def aggregate_usage():
+    """ Sum the size, file count and number of datasets per beamline and lifecycle status.
+
+    The sums are computed by the database from the summaries of the datasets, which hold
+    the size and file count of the most recent storage event of every location.
+
+    :return: A dictionary with the beamline as key and a dictionary with the lifecycle
+             status as key and a dictionary with the size, count and number of datasets
+             as value.
+    """
+    usage = {}
+    for group in Dataset._get_collection().aggregate([
+        {'$group': {
+            '_id': {'beamline': '$visit.beamline', 'status': '$summary.status'},
+            'size': {'$sum': '$summary.size'},
+            'count': {'$sum': '$summary.count'},
+            'datasets': {'$sum': 1}
+        }}
+    ]):
+        beamline = group['_id'].get('beamline')
+        status = group['_id'].get('status') or 'unknown'
+        usage.setdefault(beamline, {})[status] = {
+            'size': group['size'],
+            'count': group['count'],
+            'datasets': group['datasets']
+        }
+    return usage
+
+
+def load_usage(beamline=None):
+    """ Read the usage counters of all beamlines, or of a single beamline.
+
+    :return: A dictionary in the same form as returned by aggregate_usage.
+    """
+    query = {'beamline': beamline} if beamline is not None else {}
+    return {doc['beamline']: doc.get('statuses', {})
+            for doc in BeamlineUsage._get_collection().find(query)}
+
+
+def increment_usage(increments):
+    """ Add changes to the usage counters of the beamlines.
+
+    :param increments: Iterable of tuples (beamline, status, size, count, datasets) with
+                       the changes of the counters of a beamline and lifecycle status.
+    """
+    updates = OrderedDict()
+    for beamline, status, *values in increments:
+        if beamline is None:
+            continue
+
+        update = updates.setdefault(beamline, {})
+        for key, value in zip(USAGE_KEYS, values):
+            if value:
+                path = 'statuses.{}.{}'.format(status or 'unknown', key)
+                update[path] = update.get(path, 0) + value
+
+    requests = [UpdateOne({'beamline': beamline}, {'$inc': update}, upsert=True)
+                for beamline, update in updates.items() if len(update) > 0]
+    if len(requests) > 0:
+        try:
+            BeamlineUsage._get_collection().bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            # concurrent upserts of a new beamline conflict, retry those once
+            BeamlineUsage._get_collection().bulk_write(
+                [requests[err['index']] for err in e.details['writeErrors']], ordered=False)
+
+
+def move_usage(beamline, old_status, new_status, size, count):
+    """ Return the increments for moving a dataset from one lifecycle status to another. """
+    if old_status == new_status:
+        return []
+    return [(beamline, old_status, -size, -count, -1),
+            (beamline, new_status, size, count, 1)]
+
+
+def transfer_usage(old_beamline, new_beamline, status, size, count):
+    """ Return the increments for moving a dataset from one beamline to another. """
+    if old_beamline == new_beamline:
+        return []
+    return [(old_beamline, status, -size, -count, -1),
+            (new_beamline, status, size, count, 1)]
+
+
+def used_size(statuses):
+    """ Return the size that counts towards the quota from the usage of a beamline. """
+    return sum(values.get('size', 0) for status, values in statuses.items()
+               if status not in RELEASED_STATES)
+
+
+def exceeds_quota(beamline, size=0, usage=None):
+    """ Check whether the usage of a beamline, increased by a size, exceeds its quota.
+
+    :param usage: The usage of the beamline per status. It is read from the usage
+                  counters if it is not given.
+    """
+    pl = policy_cache.get_by_beamline(beamline)
+    if (pl is None) or (pl.quota is None):
+        return False
+
+    if usage is None:
+        usage = load_usage(beamline).get(beamline, {})
+    return used_size(usage) + size > pl.quota
+
+
+class UsageCache:
+    """ In-process cache of the storage usage of all beamlines.
+
+    The usage is read from the usage counters of all beamlines at once and kept for
+    POLICY_USAGE_TTL seconds, so that dashboards polling the usage are served from
+    memory. Concurrent requests for an expired usage share a single database query.
+    """
+
+    KEY = 'usage'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache = None
+        self._flight = SingleFlight()
+
+    def all(self):
+        """ Return the usage of all beamlines. """
+        cache = self._get_cache()
+        usage = cache.get(UsageCache.KEY)
+        if usage is None:
+            usage = self._flight.do(UsageCache.KEY, lambda: self._load(cache))
+        return usage
+
+    def get(self, beamline):
+        """ Return the usage of a beamline, which is empty if it has no datasets. """
+        return self.all().get(beamline, {})
+
+    def invalidate(self):
+        self._get_cache().invalidate()
+
+    def _load(self, cache):
+        usage = load_usage()
+        cache.set(UsageCache.KEY, usage)
+        return usage
+
+    def _get_cache(self):
+        with self._lock:
+            if self._cache is None:
+                self._cache = TTLCache(maxsize=1, ttl=current_app.config['POLICY_USAGE_TTL'])
+            return self._cache
+
+
+usage_cache = UsageCache()
+
+
+def build_usage_report(beamline, usage, quota):
+    """ Combine the usage of a beamline per lifecycle status into a quota report. """
+    totals = OrderedDict((key, 0) for key in USAGE_KEYS)
+    for status, values in usage.items():
+        if status not in RELEASED_STATES:
+            for key in totals:
+                totals[key] += values.get(key, 0)
+
+    return {
+        'beamline': beamline,
+        'quota': quota,
+        **totals,
+        'utilisation': totals['size'] / quota if quota else None,
+        'over_quota': (quota is not None) and (totals['size'] > quota),
+        'status': usage
+    }
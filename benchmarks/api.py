@@ -0,0 +1,226 @@
+""" HTTP benchmark of the dataset and policy APIs.
+
+Seeds a MongoDB database with a synthetic fleet of datasets and drives the application
+through the WSGI test client, optionally from several threads at once. For every
+scenario the requests per second and the p50, p95 and p99 latencies are reported, and
+the results can be written as JSON in order to compare them between commits.
+
+The database given by --host, --port and --db is emptied before it is seeded. Use
+--mongod to run the benchmark against a throwaway MongoDB server instead. The create
+scenario requests the visits of new EPNs from the in-process stand-in of the User
+Portal, unless another portal URL is given with --portal.
+
+Usage: python -m benchmarks.api [--datasets 10000] [--threads 4] [--requests 1000]
+                                [--mongod] [--output results.json]
+"""
+import os
+import sys
+import json
+import time
+import logging
+import random
+import argparse
+import itertools
+import subprocess
+import threading
+from collections import OrderedDict
+from contextlib import ExitStack
+from datetime import datetime
+
+from app import create_app
+from config import Config
+from benchmarks.fleet import seed_fleet
+from benchmarks.mongod import throwaway_mongod
+
+
+def search(client, rng, fleet):
+    return client.get('/dataset?beamline=BL{:02d}&limit=100'.format(
+        rng.randrange(fleet['beamlines'])))
+
+
+def retrieve(client, rng, fleet):
+    return client.get('/dataset/{}'.format(rng.choice(fleet['epns'])))
+
+
+def storage_ingest(client, rng, fleet):
+    return client.post('/dataset/{}/storage'.format(rng.choice(fleet['epns'])), json={
+        'name': 'location{}'.format(rng.randrange(fleet['storage_locations'])),
+        'host': 'host', 'path': '/data/benchmark',
+        'size': rng.randint(10 ** 6, 10 ** 12), 'count': rng.randint(1, 10 ** 5)})
+
+
+def lifecycle_renew(client, rng, fleet):
+    return client.post('/dataset/{}/lifecycle'.format(rng.choice(fleet['renewable'])),
+                       json={'user_id': 'benchmark', 'user_name': 'benchmark',
+                             'notes': '', 'days': 30})
+
+
+def create(client, rng, fleet):
+    return client.post('/dataset', json={'epn': 'new{}'.format(next(fleet['new_epns']))})
+
+
+def policy_usage(client, rng, fleet):
+    return client.get('/policy/usage')
+
+
+SCENARIOS = OrderedDict([
+    ('search', search),
+    ('retrieve', retrieve),
+    ('storage-ingest', storage_ingest),
+    ('lifecycle-renew', lifecycle_renew),
+    ('create', create),
+    ('policy-usage', policy_usage)
+])
+
+
+def run_scenario(app, scenario, fleet, requests, threads, seed):
+    """ Send a number of requests of a scenario, spread over a number of threads.
+
+    :return: A dictionary with the number of requests and errors, the requests per
+             second and the latency percentiles in milliseconds.
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(index, count):
+        client = app.test_client()
+        rng = random.Random(seed * 1000 + index)
+        local_latencies = []
+        local_errors = 0
+        for _ in range(count):
+            started = time.perf_counter()
+            response = scenario(client, rng, fleet)
+            local_latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                local_errors += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors.append(local_errors)
+
+    workers = [threading.Thread(target=worker,
+                                args=(index, requests // threads +
+                                      (1 if index < requests % threads else 0)))
+               for index in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    duration = time.perf_counter() - started
+
+    latencies.sort()
+    return OrderedDict([
+        ('requests', len(latencies)),
+        ('errors', sum(errors)),
+        ('duration', duration),
+        ('rps', len(latencies) / duration if duration > 0 else None),
+        ('mean', 1000 * sum(latencies) / len(latencies) if len(latencies) > 0 else None),
+        ('p50', _percentile(latencies, 50)),
+        ('p95', _percentile(latencies, 95)),
+        ('p99', _percentile(latencies, 99))
+    ])
+
+
+def _percentile(values, percent):
+    """ Return the percentile of sorted values in milliseconds, using the nearest rank. """
+    if len(values) == 0:
+        return None
+    rank = max(int(round(percent / 100 * len(values))) - 1, 0)
+    return 1000 * values[min(rank, len(values) - 1)]
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--datasets', type=int, default=10000,
+                        help='Number of datasets in the fleet.')
+    parser.add_argument('--beamlines', type=int, default=10,
+                        help='Number of beamlines the datasets are spread across.')
+    parser.add_argument('--storage-locations', type=int, default=2,
+                        help='Number of storage locations per dataset.')
+    parser.add_argument('--storage-depth', type=int, default=5,
+                        help='Number of storage events per storage location.')
+    parser.add_argument('--lifecycle-depth', type=int, default=3,
+                        help='Maximum number of lifecycle states per dataset.')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='Number of requests per scenario.')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Number of threads sending requests concurrently.')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS.keys()),
+                        help='Comma separated list of scenarios to run.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random number generators.')
+    parser.add_argument('--host', default=os.environ.get('MONGODB_HOST', 'localhost'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('MONGODB_PORT', 27017)))
+    parser.add_argument('--db', default='dmg_tracking_benchmark')
+    parser.add_argument('--mongod', nargs='?', const='mongod', default=None,
+                        help='Run a throwaway MongoDB server, optionally the given binary.')
+    parser.add_argument('--portal', default=None,
+                        help='URL of the User Portal, defaults to the stand-in without latency.')
+    parser.add_argument('--output', default=None, help='Write the results to this JSON file.')
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if len(unknown) > 0:
+        parser.error('Unknown scenarios: {}'.format(', '.join(unknown)))
+
+    with ExitStack() as stack:
+        host, port = args.host, args.port
+        if args.mongod is not None:
+            host, port = stack.enter_context(throwaway_mongod(args.mongod))
+
+        portal_host = args.portal or 'fake://?beamlines={}'.format(
+            ','.join('BL{:02d}'.format(index) for index in range(args.beamlines)))
+
+        class BenchmarkConfig(Config):
+            MONGODB_SETTINGS = {'db': args.db, 'host': host, 'port': port}
+            PORTAL_SETTINGS = {**Config.PORTAL_SETTINGS, 'host': portal_host}
+            SCHEDULER_SETTINGS = {**Config.SCHEDULER_SETTINGS, 'enabled': False}
+
+        app = create_app(BenchmarkConfig)
+
+        started = time.perf_counter()
+        with app.app_context():
+            fleet = seed_fleet(args.datasets, beamlines=args.beamlines,
+                               storage_locations=args.storage_locations,
+                               storage_depth=args.storage_depth,
+                               lifecycle_depth=args.lifecycle_depth, seed=args.seed)
+        fleet.update(beamlines=args.beamlines, storage_locations=args.storage_locations,
+                     new_epns=itertools.count())
+        print('Seeded {} datasets in {:.1f}s'.format(args.datasets,
+                                                     time.perf_counter() - started))
+
+        # failed requests are counted, logging every error would distort the timings
+        logging.disable(logging.ERROR)
+        results = OrderedDict()
+        print('{:<16} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+            'scenario', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+        for name in scenarios:
+            result = results[name] = run_scenario(app, SCENARIOS[name], fleet,
+                                                  args.requests, args.threads, args.seed)
+            print('{:<16} {:>8} {:>7} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+                name, result['requests'], result['errors'], result['rps'] or 0,
+                result['p50'] or 0, result['p95'] or 0, result['p99'] or 0))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(OrderedDict([
+                ('commit', _commit()),
+                ('created_at', datetime.utcnow().isoformat()),
+                ('python', sys.version.split()[0]),
+                ('parameters', vars(args)),
+                ('results', results)
+            ]), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+""" Seeding of a database with a synthetic fleet of datasets for the benchmarks. """
+import random
+from datetime import datetime, timedelta
+
+from app.api.const import LifecycleStateType
+from app.jobs import reconcile_usage
+from app.models import (Dataset, Policy, StorageEventRecord, BeamlineUsage, JobStatus,
+                        StorageEvent, LifecycleState, Visit, VisitType,
+                        PrincipalInvestigator, Organisation)
+from app.summary import build_summary
+
+
+BATCH_SIZE = 1000
+
+EPN_FORMAT = 'bench{:07d}'
+
+RENEWABLE_STATES = [LifecycleStateType.NORMAL, LifecycleStateType.RENEWED,
+                    LifecycleStateType.EXPIRED]
+
+
+def clear_fleet():
+    """ Remove all documents written by the service from the database. """
+    for document in [Dataset, StorageEventRecord, BeamlineUsage, JobStatus, Policy]:
+        document._get_collection().delete_many({})
+
+
+def seed_fleet(datasets, beamlines=10, storage_locations=2, storage_depth=5,
+               lifecycle_depth=3, seed=0):
+    """ Fill the database with a reproducible, synthetic fleet of datasets.
+
+    Every dataset has a visit on one of the beamlines, storage_locations storage
+    locations with storage_depth storage events each, and a lifecycle history of up to
+    lifecycle_depth states. Every beamline gets a policy, one visit type per beamline
+    is excluded from the retention and the usage counters are rebuilt at the end.
+
+    :return: A dictionary with the list of EPNs of all datasets and of the datasets
+             that can be renewed.
+    """
+    rng = random.Random(seed)
+    clear_fleet()
+
+    policies = []
+    for index in range(beamlines):
+        policy = Policy(beamline='BL{:02d}'.format(index), retention=rng.randint(30, 365),
+                        quota=10 ** 15, exclude_type=[index % 5], exclude_org=[],
+                        notes='benchmark')
+        policy.save()
+        policies.append(policy)
+
+    now = datetime.utcnow()
+    epns = []
+    renewable = []
+    documents = []
+    records = []
+    for index in range(datasets):
+        epn = EPN_FORMAT.format(index)
+        policy = policies[index % beamlines]
+        start = now - timedelta(days=rng.randint(0, 3 * 365), hours=rng.randint(0, 23))
+        visit = Visit(
+            id=100000 + index, start_date=start, end_date=start + timedelta(days=2),
+            title='Benchmark visit {}'.format(index), beamline=policy.beamline,
+            type=VisitType(id=rng.randint(0, 9), name_short='T', name_long='Type'),
+            pi=PrincipalInvestigator(
+                id=rng.randint(0, 999), first_names='Jane', last_name='Doe',
+                email='pi{}@example.org'.format(rng.randint(0, 999)),
+                org=Organisation(id=rng.randint(0, 49), name_short='ORG',
+                                 name_long='Organisation')))
+
+        storage = {}
+        for location in range(storage_locations):
+            name = 'location{}'.format(location)
+            for depth in range(storage_depth):
+                event = StorageEvent(
+                    created_at=start + timedelta(days=depth, seconds=location),
+                    host='host{}'.format(location), path='/data/{}/{}'.format(epn, name),
+                    size=rng.randint(10 ** 6, 10 ** 12), count=rng.randint(1, 10 ** 5),
+                    error='')
+                records.append(StorageEventRecord(epn=epn, name=name, **event._data))
+                storage[name] = event
+
+        expires_on = start + timedelta(days=policy.retention)
+        lifecycle = [LifecycleState(type=LifecycleStateType.NORMAL, created_at=start,
+                                    expires_on=expires_on, user_name='auto',
+                                    notes='auto generated during dataset creation')]
+        for depth in range(1, rng.randint(1, max(lifecycle_depth, 1))):
+            state = rng.choice([LifecycleStateType.RENEWED, LifecycleStateType.EXPIRED,
+                                LifecycleStateType.DROPPED])
+            lifecycle.insert(0, LifecycleState(
+                type=state, created_at=start + timedelta(days=30 * depth),
+                expires_on=expires_on, user_id='benchmark', user_name='benchmark', notes=''))
+            if state == LifecycleStateType.DROPPED:
+                break
+
+        dataset = Dataset(epn=epn, notes='', policy=policy, visit=visit, storage=storage,
+                          lifecycle=lifecycle)
+        dataset.summary = build_summary(dataset, policy)
+        documents.append(dataset.to_mongo())
+
+        epns.append(epn)
+        if (lifecycle[0].type in RENEWABLE_STATES) and not dataset.summary.excluded:
+            renewable.append(epn)
+
+        if len(documents) >= BATCH_SIZE:
+            _insert(documents, records)
+
+    _insert(documents, records)
+    reconcile_usage()
+    return {'epns': epns, 'renewable': renewable}
+
+
+def _insert(documents, records):
+    if len(documents) > 0:
+        Dataset._get_collection().insert_many(documents, ordered=False)
+        documents.clear()
+    if len(records) > 0:
+        StorageEventRecord._get_collection().insert_many(
+            [record.to_mongo() for record in records], ordered=False)
+        records.clear()
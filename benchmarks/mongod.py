@@ -0,0 +1,58 @@
+""" Throwaway MongoDB server for the benchmarks. """
+import time
+import shutil
+import socket
+import tempfile
+import subprocess
+from contextlib import contextmanager
+
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+
+@contextmanager
+def throwaway_mongod(binary='mongod', timeout=30):
+    """ Start a mongod with an empty, temporary data directory on a free port.
+
+    The server and its data are removed when the context is left.
+
+    :return: A tuple (host, port) of the running server.
+    """
+    path = shutil.which(binary)
+    if path is None:
+        raise RuntimeError('Could not find the MongoDB server {}'.format(binary))
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    directory = tempfile.mkdtemp(prefix='dmg-benchmark-')
+    process = subprocess.Popen([path, '--dbpath', directory, '--port', str(port),
+                                '--bind_ip', '127.0.0.1', '--quiet'],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    try:
+        _wait_for(port, process, timeout)
+        yield '127.0.0.1', port
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _wait_for(port, process, timeout):
+    deadline = time.monotonic() + timeout
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError('The MongoDB server exited with code {}'
+                               .format(process.returncode))
+        try:
+            with MongoClient('127.0.0.1', port, serverSelectionTimeoutMS=500) as client:
+                client.admin.command('ping')
+                return
+        except PyMongoError:
+            if time.monotonic() > deadline:
+                raise RuntimeError('The MongoDB server did not start within {}s'
+                                   .format(timeout))
@@ -0,0 +1,93 @@
+""" Micro-benchmark of the serialisation of a large dataset listing.
+
+Builds the response of a listing of in-memory datasets and compares the time spent
+turning it into JSON with the previous approach (every datetime converted into an
+aware local datetime and an ISO string, then the JSON support of Flask) and with the
+serialisers of the toolset, and the effect of compressing the result. No database is
+required.
+
+Usage: python -m benchmarks.serialization [--datasets 10000] [--repeat 5]
+"""
+import gzip
+import argparse
+from datetime import datetime, timedelta
+from timeit import repeat
+
+from flask import current_app, json
+from pytz import timezone
+
+from app.api.dataset import _build_dataset_response
+from app.models import (Dataset, DatasetSummary, Visit, VisitType, PrincipalInvestigator,
+                        Organisation)
+from toolset import Service
+from toolset.serializer import JsonSerializer, OrjsonSerializer, orjson
+
+
+def build_datasets(number):
+    start = datetime(2018, 1, 1)
+    return [Dataset(
+        epn='{}a'.format(10000 + i),
+        notes='',
+        visit=Visit(
+            id=i, start_date=start + timedelta(hours=i), end_date=start + timedelta(hours=i + 48),
+            title='Visit {}'.format(i), beamline='MX{}'.format(i % 3),
+            type=VisitType(id=i % 5, name_short='T', name_long='Type'),
+            pi=PrincipalInvestigator(
+                id=i % 100, first_names='A', last_name='B', email='a@b.org',
+                org=Organisation(id=i % 20, name_short='O', name_long='Organisation'))),
+        summary=DatasetSummary(status='normal', expires_on=start + timedelta(days=i),
+                               size=1000 * i, count=i, locations=1, unavailable=0))
+        for i in range(number)]
+
+
+def to_iso(value):
+    """ Convert all datetimes of a response the way the responses were built before. """
+    if isinstance(value, dict):
+        return {key: to_iso(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [to_iso(item) for item in value]
+    if isinstance(value, datetime):
+        return value.astimezone(current_app.config['TIMEZONE']).isoformat()
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--datasets', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    tz = timezone('Australia/Melbourne')
+    app = Service(__name__)
+    app.config['TIMEZONE'] = tz
+    datasets = build_datasets(args.datasets)
+
+    with app.app_context():
+        def listing():
+            return {'datasets': [_build_dataset_response(ds) for ds in datasets], 'next': None}
+
+        value = listing()
+        cases = [
+            ('build response', lambda _: listing()),
+            ('local iso strings + flask', lambda v: json.dumps(to_iso(v), sort_keys=True)),
+            ('JsonSerializer', JsonSerializer(tz=tz).dumps)
+        ]
+        if orjson is not None:
+            cases.append(('OrjsonSerializer', OrjsonSerializer(tz=tz).dumps))
+
+        print('{} datasets, best of {} runs'.format(args.datasets, args.repeat))
+        for name, fn in cases:
+            best = min(repeat(lambda: fn(value), number=1, repeat=args.repeat))
+            print('  {:<28} {:8.1f} ms'.format(name, best * 1000))
+
+        body = app.serializer.dumps(value)
+        for level in [1, 6]:
+            best = min(repeat(lambda: gzip.compress(body, compresslevel=level),
+                              number=1, repeat=args.repeat))
+            print('  gzip level {} {:>17} {:8.1f} ms  {:.1f} MB -> {:.1f} MB'.format(
+                level, '', best * 1000, len(body) / 1e6,
+                len(gzip.compress(body, compresslevel=level)) / 1e6))
+
+
+if __name__ == '__main__':
+    main()
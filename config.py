@@ -13,7 +13,49 @@ class Config:
         'host': os.environ.get('PORTAL_HOST', default='localhost'),
         'client': os.environ.get('PORTAL_CLIENT', default=None),
         'password': os.environ.get('PORTAL_PASSWORD', default=None),
-        'verify': distutils.util.strtobool(os.environ.get('PORTAL_VERIFY', default='True'))
+        'verify': distutils.util.strtobool(os.environ.get('PORTAL_VERIFY', default='True')),
+        'token_lifetime': int(os.environ.get('PORTAL_TOKEN_LIFETIME', default=3600)),
+        'token_refresh_margin': int(os.environ.get('PORTAL_TOKEN_REFRESH_MARGIN', default=60)),
+        'workers': int(os.environ.get('PORTAL_WORKERS', default=8))
+    }
+
+    PORTAL_CACHE_SETTINGS = {
+        'max_size': int(os.environ.get('PORTAL_CACHE_SIZE', default=1024)),
+        'visit_ttl': int(os.environ.get('PORTAL_VISIT_TTL', default=300)),
+        'equipment_ttl': int(os.environ.get('PORTAL_EQUIPMENT_TTL', default=86400))
+    }
+
+    POLICY_CACHE_CHECK_INTERVAL = float(os.environ.get('POLICY_CACHE_CHECK_INTERVAL', default=1))
+    POLICY_USAGE_TTL = int(os.environ.get('POLICY_USAGE_TTL', default=30))
+    POLICY_QUOTA_ENFORCED = distutils.util.strtobool(
+        os.environ.get('POLICY_QUOTA_ENFORCED', default='False'))
+
+    DATASET_PAGE_SIZE = int(os.environ.get('DATASET_PAGE_SIZE', default=100))
+    DATASET_PAGE_LIMIT = int(os.environ.get('DATASET_PAGE_LIMIT', default=1000))
+    DATASET_STREAM_BATCH_SIZE = int(os.environ.get('DATASET_STREAM_BATCH_SIZE', default=500))
+    DATASET_BULK_LIMIT = int(os.environ.get('DATASET_BULK_LIMIT', default=1000))
+    DATASET_UPDATE_RETRIES = int(os.environ.get('DATASET_UPDATE_RETRIES', default=5))
+    STORAGE_EVENT_RETENTION = float(os.environ.get('STORAGE_EVENT_RETENTION', default=0))
+    VISIT_REFRESH_RATE = float(os.environ.get('VISIT_REFRESH_RATE', default=10))
+
+    METRICS_ENABLED = distutils.util.strtobool(os.environ.get('METRICS_ENABLED', default='True'))
+    DB_PROFILING = os.environ.get('DB_PROFILING', default='off')
+    DB_PROFILING_REPEAT_LIMIT = int(os.environ.get('DB_PROFILING_REPEAT_LIMIT', default=5))
+
+    RESPONSE_COMPRESSION_THRESHOLD = int(
+        os.environ.get('RESPONSE_COMPRESSION_THRESHOLD', default=1024))
+    RESPONSE_COMPRESSION_LEVEL = int(os.environ.get('RESPONSE_COMPRESSION_LEVEL', default=6))
+
+    SCHEDULER_SETTINGS = {
+        'enabled': distutils.util.strtobool(
+            os.environ.get('SCHEDULER_ENABLED', default='False')),
+        'poll_interval': float(os.environ.get('SCHEDULER_POLL_INTERVAL', default=10)),
+        'lease': int(os.environ.get('SCHEDULER_LEASE', default=3600)),
+        'intervals': {
+            'expire-datasets': int(os.environ.get('SCHEDULE_EXPIRE_DATASETS', default=3600)),
+            'refresh-visits': int(os.environ.get('SCHEDULE_REFRESH_VISITS', default=0)),
+            'reconcile-usage': int(os.environ.get('SCHEDULE_RECONCILE_USAGE', default=0))
+        }
     }
 
     MONGODB_SETTINGS = {
@@ -21,6 +63,8 @@ class Config:
         'host': os.environ.get('MONGODB_HOST', default='localhost'),
         'port': int(os.environ.get('MONGODB_PORT', default=27017)),
     }
+    MONGODB_CREATE_INDEXES = distutils.util.strtobool(
+        os.environ.get('MONGODB_CREATE_INDEXES', default='True'))
 
     SWAGGER = {
         'specs_route': '/docs/',
@@ -0,0 +1,102 @@
+import time
+import threading
+
+import pytest
+
+from toolset.cache import TTLCache, SingleFlight
+
+
+def test_ttl_cache_returns_stored_values():
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('b', default=2) == 2
+
+
+def test_ttl_cache_expires_entries(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    cache = TTLCache(maxsize=10, ttl=5)
+    cache.set('a', 1)
+
+    now[0] = 104.9
+    assert cache.get('a') == 1
+    now[0] = 105.0
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+
+
+def test_ttl_cache_invalidates_single_and_all_entries():
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    cache.invalidate('a')
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+
+    cache.invalidate()
+    assert len(cache) == 0
+
+
+@pytest.mark.parametrize('maxsize, ttl', [(0, 60), (10, 0)])
+def test_ttl_cache_can_be_disabled(maxsize, ttl):
+    cache = TTLCache(maxsize=maxsize, ttl=ttl)
+    cache.set('a', 1)
+    assert not cache.enabled
+    assert cache.get('a') is None
+
+
+def test_single_flight_shares_one_call_between_concurrent_callers():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def load():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'value'
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do('key', load)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do('key', load)))
+                 for _ in range(3)]
+    for thread in followers:
+        thread.start()
+
+    # give the followers time to join the running call
+    time.sleep(0.1)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert results == ['value'] * 4
+
+
+def test_single_flight_shares_exceptions_and_forgets_finished_calls():
+    flight = SingleFlight()
+
+    def fail():
+        raise ValueError('failed')
+
+    with pytest.raises(ValueError):
+        flight.do('key', fail)
+    assert flight.do('key', lambda: 'value') == 'value'
@@ -0,0 +1,42 @@
+import pytest
+from bson import ObjectId
+
+from app.api.dataset import _check_if_match, _dataset_etag
+from toolset import Service, ApiError, StatusCode
+
+
+DATASET_ID = ObjectId()
+
+
+@pytest.fixture
+def app():
+    return Service(__name__)
+
+
+@pytest.mark.parametrize('header', [
+    None,
+    '"{}"'.format(_dataset_etag(DATASET_ID, 3)),
+    '"{}-gzip"'.format(_dataset_etag(DATASET_ID, 3)),
+    '"other", "{}"'.format(_dataset_etag(DATASET_ID, 3)),
+    '*'
+])
+def test_if_match_accepts_the_current_revision(app, header):
+    headers = {'If-Match': header} if header is not None else {}
+    with app.test_request_context(headers=headers):
+        _check_if_match(DATASET_ID, 3)
+
+
+@pytest.mark.parametrize('header', [
+    '"{}"'.format(_dataset_etag(DATASET_ID, 2)),
+    '"{}-gzip"'.format(_dataset_etag(DATASET_ID, 2)),
+    'W/"{}"'.format(_dataset_etag(DATASET_ID, 3))
+])
+def test_if_match_rejects_other_revisions_and_weak_tags(app, header):
+    with app.test_request_context(headers={'If-Match': header}):
+        with pytest.raises(ApiError) as err:
+            _check_if_match(DATASET_ID, 3)
+    assert err.value.status == StatusCode.PreconditionFailed
+
+
+def test_missing_revision_counts_as_zero():
+    assert _dataset_etag(DATASET_ID, None) == _dataset_etag(DATASET_ID, 0)
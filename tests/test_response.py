@@ -0,0 +1,63 @@
+import gzip
+import json
+
+import pytest
+
+from toolset import Service, ApiResponse, ApiStreamResponse, ApiError, StatusCode
+
+
+@pytest.fixture
+def app():
+    app = Service(__name__)
+    app.config['RESPONSE_COMPRESSION_THRESHOLD'] = 100
+    return app
+
+
+def test_large_responses_are_compressed_with_their_own_etag(app):
+    value = {'items': list(range(100))}
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+        response = ApiResponse(value, headers={'ETag': '"abc.1"'}).to_flask_response()
+
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['ETag'] == '"abc.1-gzip"'
+    assert 'Accept-Encoding' in response.vary
+    assert json.loads(gzip.decompress(response.get_data()).decode('utf-8')) == value
+
+
+@pytest.mark.parametrize('value, accept', [
+    ({'items': list(range(100))}, 'identity'),
+    ({'items': []}, 'gzip')
+])
+def test_uncompressed_responses_vary_on_the_encoding(app, value, accept):
+    with app.test_request_context(headers={'Accept-Encoding': accept}):
+        response = ApiResponse(value, headers={'ETag': '"abc.1"'}).to_flask_response()
+
+    assert 'Content-Encoding' not in response.headers
+    assert response.headers['ETag'] == '"abc.1"'
+    assert 'Accept-Encoding' in response.vary
+
+
+def test_weak_etags_are_kept_when_compressed(app):
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+        response = ApiResponse({'items': list(range(100))},
+                               headers={'ETag': 'W/"abc.1"'}).to_flask_response()
+    assert response.headers['ETag'] == 'W/"abc.1"'
+
+
+def test_stream_ends_with_an_error_record(app):
+    def values():
+        yield {'a': 1}
+        raise ApiError(StatusCode.InternalServerError, 'failed')
+
+    def broken():
+        yield {'a': 1}
+        raise RuntimeError('connection lost')
+
+    with app.test_request_context():
+        for generator, message in [(values(), 'failed'),
+                                   (broken(), 'connection lost')]:
+            response = ApiStreamResponse(generator).to_flask_response()
+            lines = [json.loads(line) for line in
+                     b''.join(response.response).decode('utf-8').splitlines()]
+            assert lines[0] == {'a': 1}
+            assert message in lines[1]['error']
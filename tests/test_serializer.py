@@ -0,0 +1,82 @@
+import json
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+from pytz import timezone as pytz_timezone, utc
+
+from toolset.serializer import LocalTimeFormatter, JsonSerializer, OrjsonSerializer, orjson
+
+
+MELBOURNE = pytz_timezone('Australia/Melbourne')
+
+# around the end of daylight saving time in Melbourne on 2018-04-01 at 16:00 UTC
+DATETIMES = [datetime(2018, 3, 31, 12, 0) + timedelta(minutes=45 * i) for i in range(16)] +\
+    [datetime(2018, 1, 1, 3, 4, 5, 123456), datetime(2018, 7, 1)]
+
+
+def reference(value):
+    return value.replace(tzinfo=utc).astimezone(MELBOURNE)
+
+
+@pytest.mark.parametrize('value', DATETIMES)
+def test_formatter_formats_naive_datetimes_as_utc_in_the_timezone(value):
+    formatter = LocalTimeFormatter(MELBOURNE)
+    assert formatter(value) == reference(value).isoformat()
+
+
+@pytest.mark.parametrize('value', DATETIMES)
+def test_formatter_localizes_naive_datetimes(value):
+    localized = LocalTimeFormatter(MELBOURNE).localize(value)
+    assert localized == reference(value)
+    assert localized.isoformat() == reference(value).isoformat()
+
+
+def test_formatter_converts_aware_datetimes_and_keeps_none():
+    formatter = LocalTimeFormatter(MELBOURNE)
+    value = datetime(2018, 1, 1, tzinfo=timezone.utc)
+    assert formatter(value) == '2018-01-01T11:00:00+11:00'
+    assert formatter.localize(value).isoformat() == '2018-01-01T11:00:00+11:00'
+    assert formatter.localize(None) is None
+
+
+def test_formatter_defaults_to_utc():
+    assert LocalTimeFormatter()(datetime(2018, 1, 1, 3)) == '2018-01-01T03:00:00+00:00'
+
+
+def test_json_serializer_writes_dates_and_datetimes():
+    serializer = JsonSerializer(tz=MELBOURNE)
+    value = {'b': date(2018, 1, 1), 'a': datetime(2018, 1, 1), 'c': None}
+    assert serializer.dumps(value) ==\
+        b'{"a": "2018-01-01T11:00:00+11:00", "b": "2018-01-01", "c": null}'
+
+
+def test_json_serializer_rejects_unknown_types():
+    with pytest.raises(TypeError):
+        JsonSerializer().dumps({'a': object()})
+
+
+@pytest.mark.skipif(orjson is None, reason='orjson is not installed')
+@pytest.mark.parametrize('sort_keys', [True, False])
+def test_orjson_serializer_matches_json_serializer(sort_keys):
+    formatter = LocalTimeFormatter(MELBOURNE)
+    value = {
+        'datasets': [{'epn': str(i), 'created_at': formatter.localize(dt), 'size': i,
+                      'available': i % 2 == 0, 'notes': None, 'on': dt.date()}
+                     for i, dt in enumerate(DATETIMES)],
+        'next': None
+    }
+
+    expected = JsonSerializer(sort_keys, MELBOURNE).dumps(value)
+    result = OrjsonSerializer(sort_keys, MELBOURNE).dumps(value)
+
+    assert isinstance(result, bytes)
+    assert json.loads(result.decode('utf-8')) == json.loads(expected.decode('utf-8'))
+    if sort_keys:
+        assert result.decode('utf-8') == json.dumps(json.loads(expected.decode('utf-8')),
+                                                    sort_keys=True, separators=(',', ':'))
+
+
+@pytest.mark.skipif(orjson is None, reason='orjson is not installed')
+def test_orjson_serializer_writes_naive_datetimes_in_utc():
+    assert OrjsonSerializer(tz=MELBOURNE).dumps({'a': datetime(2018, 1, 1, 3)}) ==\
+        b'{"a":"2018-01-01T03:00:00+00:00"}'
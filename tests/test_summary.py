@@ -0,0 +1,67 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+from app.models import StorageEvent
+from app.summary import build_document_summary, storage_summary_increments
+
+
+def event(size, count, created_at=datetime(2018, 1, 2)):
+    return {'created_at': created_at, 'host': 'h', 'path': 'p', 'size': size, 'count': count,
+            'error': ''}
+
+
+def dataset(storage):
+    return {
+        'epn': '1234a',
+        'visit': {'id': 1, 'beamline': 'MX1', 'title': 't',
+                  'type': {'id': 2, 'name_short': 'T', 'name_long': 'Type'},
+                  'pi': {'id': 3, 'first_names': 'A', 'last_name': 'B', 'email': 'Jane@Example.org',
+                         'org': {'id': 4, 'name_short': 'O', 'name_long': 'Org'}}},
+        'storage': storage,
+        'lifecycle': [{'type': 'renewed', 'created_at': datetime(2018, 1, 3),
+                       'expires_on': datetime(2018, 2, 1)},
+                      {'type': 'normal', 'created_at': datetime(2018, 1, 1),
+                       'expires_on': datetime(2018, 1, 11)}]
+    }
+
+
+def test_build_document_summary_uses_latest_events():
+    summary = build_document_summary(
+        dataset({'a': event(5, 2), 'b': event(None, None)}), None)
+
+    assert (summary.size, summary.count) == (5, 2)
+    assert (summary.locations, summary.unavailable) == (2, 1)
+    assert (summary.status, summary.expires_on) == ('renewed', datetime(2018, 2, 1))
+    assert (summary.beamline, summary.contact) == ('mx1', 'jane@example.org')
+    assert not summary.excluded
+
+
+def test_build_document_summary_reads_unmigrated_storage_histories():
+    summary = build_document_summary(
+        dataset({'a': [event(7, 3), event(5, 2)], 'b': []}), None)
+
+    assert (summary.size, summary.count) == (7, 3)
+    assert (summary.locations, summary.unavailable) == (1, 0)
+
+
+def test_build_document_summary_applies_the_policy():
+    policy = SimpleNamespace(exclude_type=[2], exclude_org=[])
+    assert build_document_summary(dataset({}), policy).excluded
+
+
+def test_storage_summary_increments_of_a_new_location():
+    assert storage_summary_increments(None, StorageEvent(size=5, count=2)) == {
+        'summary.size': 5, 'summary.count': 2, 'summary.locations': 1, 'summary.unavailable': 0}
+
+
+def test_storage_summary_increments_of_a_replaced_event():
+    previous = StorageEvent(size=5, count=2)
+    assert storage_summary_increments(previous, StorageEvent(size=3, count=4)) == {
+        'summary.size': -2, 'summary.count': 2, 'summary.locations': 0, 'summary.unavailable': 0}
+
+
+def test_storage_summary_increments_of_a_location_becoming_unavailable():
+    previous = StorageEvent(size=5, count=2)
+    assert storage_summary_increments(previous, StorageEvent(size=None, count=None)) == {
+        'summary.size': -5, 'summary.count': -2, 'summary.locations': 0,
+        'summary.unavailable': 1}
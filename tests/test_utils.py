@@ -0,0 +1,21 @@
+import pytest
+from bson import ObjectId
+
+from app.api.utils import encode_cursor, decode_cursor
+from toolset import ApiError, StatusCode
+
+
+def test_cursor_round_trip():
+    object_id = ObjectId()
+    cursor = encode_cursor(object_id)
+
+    assert isinstance(cursor, str)
+    assert str(object_id) not in cursor
+    assert decode_cursor(cursor) == object_id
+
+
+@pytest.mark.parametrize('cursor', ['', 'not a cursor', 'AAAA', 'é'])
+def test_invalid_cursors_are_rejected(cursor):
+    with pytest.raises(ApiError) as err:
+        decode_cursor(cursor)
+    assert err.value.status == StatusCode.BadRequest
@@ -1,4 +1,4 @@
 from .service import Service
-from .response import ApiResponse, ApiError, StatusCode
+from .response import ApiResponse, ApiStreamResponse, ApiError, StatusCode
 
-__all__ = ['Service', 'ApiResponse', 'ApiError', 'StatusCode']
+__all__ = ['Service', 'ApiResponse', 'ApiStreamResponse', 'ApiError', 'StatusCode']
@@ -0,0 +1,98 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """ Thread safe cache with a maximum size whose entries expire after a fixed time.
+
+    Once the cache is full, the least recently used entry is evicted. A time to live
+    of zero disables the cache.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return (self._ttl > 0) and (self._maxsize > 0)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires_at, value = self._data[key]
+            except KeyError:
+                return default
+
+            if time.monotonic() >= expires_at:
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._data[key] = (time.monotonic() + self._ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """ Remove a single entry or, if no key is given, all entries from the cache. """
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SingleFlight:
+    """ Coalesces concurrent calls for the same key into a single call.
+
+    The first caller for a key executes the function, all callers arriving while it
+    is running wait for it and share its result or exception.
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = SingleFlight._Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
@@ -0,0 +1,162 @@
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    """ Base class of a metric with an optional set of labels.
+
+    The values of the labels are passed as positional arguments, in the order of the
+    label names given when the metric was created.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _check(self, label_values):
+        if len(label_values) != len(self.labels):
+            raise ValueError('The metric {} expects the labels {}'.format(
+                self.name, ', '.join(self.labels)))
+        return label_values
+
+    def samples(self):
+        """ Return a list of tuples (name, labels, value) with the current values. """
+        with self._lock:
+            return [(self.name, self._label_pairs(key), value)
+                    for key, value in self._values.items()]
+
+    def _label_pairs(self, label_values, *extra):
+        return tuple(zip(self.labels, label_values)) + extra
+
+
+class Counter(Metric):
+    """ A value that only ever increases, such as the number of calls. """
+
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        key = self._check(label_values)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """ A value that goes up and down, such as the number of requests in flight. """
+
+    type = 'gauge'
+
+    def inc(self, *label_values, amount=1):
+        key = self._check(label_values)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, value, *label_values):
+        key = self._check(label_values)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """ Counts observations, such as durations in seconds, in configurable buckets. """
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *label_values):
+        key = self._check(label_values)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # one count per bucket, followed by the count above all buckets and the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+
+        samples = []
+        for key, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                samples.append((self.name + '_bucket',
+                                self._label_pairs(key, ('le', _format_value(bound))), total))
+            samples.append((self.name + '_sum', self._label_pairs(key), counts[-1]))
+            samples.append((self.name + '_count', self._label_pairs(key), total))
+        return samples
+
+
+class Metrics:
+    """ Registry of the metrics of a service, rendered in the Prometheus text format.
+
+    Creating a metric with the name of an existing metric of the same type returns the
+    existing metric, so that components can be initialised more than once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = OrderedDict()
+
+    def counter(self, name, documentation, labels=()):
+        return self._register(Counter, name, documentation, labels)
+
+    def gauge(self, name, documentation, labels=()):
+        return self._register(Gauge, name, documentation, labels)
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, labels, buckets=buckets)
+
+    def render(self):
+        """ Return all metrics in the Prometheus text exposition format. """
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name, _escape(metric.documentation)))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                if len(labels) > 0:
+                    name = '{}{{{}}}'.format(name, ','.join(
+                        '{}="{}"'.format(label, _escape(str(label_value)).replace('"', '\\"'))
+                        for label, label_value in labels))
+                lines.append('{} {}'.format(name, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, cls, name, documentation, labels, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labels, **kwargs)
+            elif not isinstance(metric, cls) or (metric.labels != tuple(labels)):
+                raise ValueError('The metric {} is already registered with a different type '
+                                 'or labels'.format(name))
+            return metric
+
+
+def _escape(text):
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _format_value(value):
+    return '+Inf' if value == float('inf') else str(value)
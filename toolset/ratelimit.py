@@ -0,0 +1,27 @@
+import time
+import threading
+
+
+class RateLimiter:
+    """ Thread safe limiter that spaces calls out to at most `rate` calls per second.
+
+    A rate of zero or less disables the limit.
+    """
+
+    def __init__(self, rate):
+        self._interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Block until the next call is allowed. """
+        if self._interval <= 0:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self._interval
+
+        if slot > now:
+            time.sleep(slot - now)
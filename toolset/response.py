@@ -1,27 +1,91 @@
+import gzip
 import logging
-from flask import json, Response
+from flask import current_app, request, Response, stream_with_context
+
+
+# appended to the entity tag of a compressed response, which is a different representation
+GZIP_ETAG_SUFFIX = '-gzip'
 
 
 class StatusCode:
     Ok = 200
+    Accepted = 202
+    NotModified = 304
     BadRequest = 400
     Unauthorized = 401
     NotFound = 404
     MethodNotAllowed = 405
+    Conflict = 409
+    PreconditionFailed = 412
     UnprocessableEntity = 422
     InternalServerError = 500
 
 
 class ApiResponse:
 
-    def __init__(self, value, status=StatusCode.Ok):
+    def __init__(self, value, status=StatusCode.Ok, headers=None):
         self._value = value
         self._status = status
+        self._headers = headers
+
+    def to_flask_response(self):
+        body = current_app.serializer.dumps(self._value) if self._value is not None else b''
+        response = Response(body,
+                            status=self._status,
+                            headers=self._headers,
+                            mimetype='application/json')
+        return _compress(response, body)
+
+
+class ApiStreamResponse(ApiResponse):
+    """ Response that streams an iterable of values as newline delimited JSON.
+
+    The status is sent before the values are produced, so an error raised while the
+    response is streamed, for example by the database, ends the stream with a final
+    record holding the error message.
+    """
 
     def to_flask_response(self):
-        return Response(json.dumps(self._value),
+        def generate():
+            serializer = current_app.serializer
+            try:
+                for value in self._value:
+                    yield serializer.dumps(value) + b'\n'
+            except ApiError as err:
+                logging.getLogger(__name__).error(err.message)
+                yield serializer.dumps({'error': err.message}) + b'\n'
+            except Exception as err:
+                logging.getLogger(__name__).exception('The streamed response failed')
+                message = 'An error occurred while streaming the response: {}'.format(err)
+                yield serializer.dumps({'error': message}) + b'\n'
+
+        return Response(stream_with_context(generate()),
                         status=self._status,
-                        mimetype='application/json')
+                        headers=self._headers,
+                        mimetype='application/x-ndjson')
+
+
+def _compress(response, body):
+    """ Compress the body of a response with gzip if it is larger than the configured
+    threshold and the client accepts it. A threshold of zero disables compression.
+
+    A strong entity tag of the response gets the suffix GZIP_ETAG_SUFFIX if the body is
+    compressed, since both representations differ byte for byte.
+    """
+    response.vary.add('Accept-Encoding')
+    threshold = current_app.config.get('RESPONSE_COMPRESSION_THRESHOLD', 0)
+    if (threshold <= 0) or (len(body) < threshold) or\
+            (request.accept_encodings.quality('gzip') <= 0):
+        return response
+
+    response.set_data(gzip.compress(
+        body, compresslevel=current_app.config.get('RESPONSE_COMPRESSION_LEVEL', 6)))
+    response.headers['Content-Encoding'] = 'gzip'
+
+    etag, weak = response.get_etag()
+    if (etag is not None) and not weak:
+        response.set_etag(etag + GZIP_ETAG_SUFFIX)
+    return response
 
 
 class ApiError(RuntimeError):
@@ -30,6 +94,14 @@ class ApiError(RuntimeError):
         self._status = status
         self._message = message
 
+    @property
+    def status(self):
+        return self._status
+
+    @property
+    def message(self):
+        return self._message
+
     def to_flask_response(self):
         logger = logging.getLogger(__name__)
         logger.error(self._message)
@@ -0,0 +1,130 @@
+from datetime import date, datetime, timezone
+from flask import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+class LocalTimeFormatter:
+    """ Converts datetimes into a timezone and formats them as ISO 8601 strings.
+
+    Naive datetimes are taken to be in UTC, which is how MongoDB returns them. Instead of
+    converting every datetime with the timezone, the offset of the timezone is looked up
+    once per day and applied to all datetimes of that day. Days on which the offset
+    changes are converted one datetime at a time.
+    """
+
+    def __init__(self, tz=None, max_size=65536):
+        self._tz = tz or timezone.utc
+        self._max_size = max_size
+        self._days = {}
+
+    def __call__(self, value):
+        if value.tzinfo is not None:
+            return value.astimezone(self._tz).isoformat()
+
+        offset = self._offset(value)
+        if offset is False:
+            return self._convert(value).isoformat()
+
+        delta, suffix, _ = offset
+        return (value + delta).isoformat() + suffix
+
+    def localize(self, value):
+        """ Return a datetime as an aware datetime in the timezone, or None for None.
+
+        On days with a single offset, the datetime gets a fixed offset timezone, which
+        orjson serialises natively.
+        """
+        if value is None:
+            return None
+        if value.tzinfo is not None:
+            return value.astimezone(self._tz)
+
+        offset = self._offset(value)
+        if offset is False:
+            return self._convert(value)
+
+        delta, _, tzinfo = offset
+        value += delta
+        # considerably faster than replacing the tzinfo of the datetime
+        return datetime.combine(value.date(), value.time(), tzinfo)
+
+    def _offset(self, value):
+        day = value.toordinal()
+        offset = self._days.get(day)
+        if offset is None:
+            offset = self._day_offset(day)
+        return offset
+
+    def _convert(self, value):
+        return value.replace(tzinfo=timezone.utc).astimezone(self._tz)
+
+    def _day_offset(self, day):
+        start = self._convert(datetime.fromordinal(day))
+        end = self._convert(datetime.fromordinal(day + 1))
+        if start.utcoffset() == end.utcoffset():
+            # the isoformat of a datetime without microseconds ends with the offset
+            offset = start.utcoffset(), start.isoformat()[19:], timezone(start.utcoffset())
+        else:
+            offset = False
+
+        if len(self._days) >= self._max_size:
+            self._days.clear()
+        self._days[day] = offset
+        return offset
+
+
+class JsonSerializer:
+    """ Serialises response values to JSON using the JSON support of Flask.
+
+    Dates and datetimes are written in ISO 8601 format. Aware datetimes are written with
+    their own offset and naive datetimes, taken to be in UTC, in the given timezone.
+    """
+
+    def __init__(self, sort_keys=True, tz=None):
+        self._sort_keys = sort_keys
+        self._format_datetime = LocalTimeFormatter(tz)
+
+    def dumps(self, value):
+        """ Return the JSON representation of a value as bytes. """
+        return json.dumps(value, sort_keys=self._sort_keys,
+                          default=self._default).encode('utf-8')
+
+    def _default(self, value):
+        if isinstance(value, datetime):
+            # aware datetimes keep their offset, as they do with orjson
+            if value.tzinfo is not None:
+                return value.isoformat()
+            return self._format_datetime(value)
+        if isinstance(value, date):
+            return value.isoformat()
+        raise TypeError('Object of type {} is not JSON serializable'
+                        .format(value.__class__.__name__))
+
+
+class OrjsonSerializer(JsonSerializer):
+    """ Serialises response values to JSON using orjson, which is considerably faster.
+
+    Datetimes are written by orjson itself, which is only as fast as it gets if they
+    don't have to be passed back to Python. Aware datetimes are therefore written with
+    their own offset, so responses should hold datetimes that were converted into the
+    service timezone up front, see LocalTimeFormatter.localize. Unlike the default
+    serialiser, naive datetimes are written in UTC with the offset +00:00.
+    """
+
+    def __init__(self, sort_keys=True, tz=None):
+        super().__init__(sort_keys, tz)
+        self._options = orjson.OPT_NAIVE_UTC | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+
+    def dumps(self, value):
+        return orjson.dumps(value, default=self._default, option=self._options)
+
+
+def default_serializer(sort_keys=True, tz=None):
+    """ Return the fastest serialiser that is available. """
+    if orjson is not None:
+        return OrjsonSerializer(sort_keys, tz)
+    return JsonSerializer(sort_keys, tz)
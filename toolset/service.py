@@ -1,11 +1,92 @@
-from flask import Flask
+import time
+from flask import Flask, g, request
 
+from .metrics import Metrics
 from .response import ApiResponse
+from .serializer import default_serializer
 
 
 class Service(Flask):
+    """ Flask application serving API responses, instrumented with request metrics.
+
+    The latency of every request is recorded per endpoint, method and status code,
+    together with the number of requests in flight and the time spent serialising API
+    responses. Set METRICS_ENABLED to False to turn the instrumentation off.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._serializer = None
+
+        self.metrics = Metrics()
+        self._request_duration = self.metrics.histogram(
+            'http_request_duration_seconds', 'Time spent serving HTTP requests',
+            ['endpoint', 'method', 'status'])
+        self._requests_in_flight = self.metrics.gauge(
+            'http_requests_in_flight', 'Number of HTTP requests currently being served')
+        self._serialization_duration = self.metrics.histogram(
+            'http_response_serialization_seconds', 'Time spent serialising API responses',
+            ['endpoint'])
+
+        self.before_request(self._start_request)
+        self.after_request(self._record_status)
+        self.teardown_request(self._finish_request)
+
+    @property
+    def serializer(self):
+        """ The serialiser used to turn the values of API responses into JSON.
+
+        Defaults to the fastest available serialiser and can be replaced by any object
+        with a dumps method that returns bytes.
+        """
+        if self._serializer is None:
+            # newer versions of Flask moved the option from the config to the JSON provider
+            sort_keys = self.config.get('JSON_SORT_KEYS')
+            if sort_keys is None:
+                sort_keys = getattr(getattr(self, 'json', None), 'sort_keys', True)
+            self._serializer = default_serializer(sort_keys, self.config.get('TIMEZONE'))
+        return self._serializer
+
+    @serializer.setter
+    def serializer(self, serializer):
+        self._serializer = serializer
+
+    @property
+    def metrics_enabled(self):
+        return self.config.get('METRICS_ENABLED', True)
 
     def make_response(self, rv):
         if isinstance(rv, ApiResponse):
-            return rv.to_flask_response()
+            if not self.metrics_enabled:
+                return rv.to_flask_response()
+
+            started = time.perf_counter()
+            response = rv.to_flask_response()
+            self._serialization_duration.observe(time.perf_counter() - started,
+                                                 _endpoint())
+            return response
         return Flask.make_response(self, rv)
+
+    def _start_request(self):
+        if self.metrics_enabled:
+            g._request_started = time.perf_counter()
+            self._requests_in_flight.inc()
+
+    def _record_status(self, response):
+        g._request_status = response.status_code
+        return response
+
+    def _finish_request(self, exc):
+        started = g.pop('_request_started', None)
+        if started is None:
+            return
+
+        self._requests_in_flight.dec()
+        self._request_duration.observe(time.perf_counter() - started,
+                                       _endpoint(), request.method,
+                                       str(g.pop('_request_status', 500)))
+
+
+def _endpoint():
+    # requests that did not match any route are grouped, to keep the number of labels bounded
+    return request.endpoint or 'unmatched'